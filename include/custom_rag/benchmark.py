@@ -0,0 +1,308 @@
+# Copyright 2024 DataRobot, Inc. and its affiliates.
+# All rights reserved.
+# DataRobot, Inc.
+# This is proprietary source code of DataRobot, Inc. and its
+# affiliates.
+# Released under the terms of DataRobot Tool and Utility Agreement.
+
+"""Offline throughput benchmark for the custom RAG model's `score` hook.
+
+Builds a fixture vector database from a synthetic corpus, swaps Azure OpenAI for
+a fake chat model with configurable latency and output size and scores generated
+batches, reporting rows/s, per-stage latency percentiles and peak RSS. Run from
+this directory, e.g.
+
+    python benchmark.py --rows 200 --batches 3 --latency-secs 0.5 --output run.json
+    python benchmark.py --param max_concurrency=16 --baseline run.json
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Any
+
+import numpy as np
+import yaml
+from custom import SCORING_PARAMS, STAGES, cast_scoring_params, get_chain, score
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pandas import DataFrame, concat  # type: ignore
+
+PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[2]
+PARAMETERS_PATH = PROJECT_ROOT / "conf/base/parameters_deploy_custom_rag.yml"
+# The fixture is written by the pipeline's own index and docstore code
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+VOCABULARY = [f"term{i}" for i in range(5000)]
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that sleeps for a normally distributed latency and returns
+    `completion_tokens` words, reporting token usage like Azure OpenAI does."""
+
+    latency_secs: float = 0.5
+    jitter_secs: float = 0.1
+    completion_tokens: int = 100
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(max(0.0, random.gauss(self.latency_secs, self.jitter_secs)))
+        prompt_tokens = sum(len(str(m.content).split()) for m in messages)
+        message = AIMessage(
+            content=" ".join(["answer"] * self.completion_tokens),
+            usage_metadata={
+                "input_tokens": prompt_tokens,
+                "output_tokens": self.completion_tokens,
+                "total_tokens": prompt_tokens + self.completion_tokens,
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def build_fixture(
+    folder_path,
+    embedding_function,
+    n_docs,
+    words_per_doc,
+    rng,
+    index_params=None,
+    id_mapped=False,
+):
+    """Write a vectorstore over a synthetic corpus like the deploy_custom_rag nodes.
+
+    With `id_mapped`, the index is searched by sparse, unordered chunk IDs, as
+    after incremental updates, and the docstore maps them in `docstore_ids.npy`.
+    Returns the corpus texts.
+    """
+    from aragog.pipelines.deploy_custom_rag.nodes import (
+        _make_faiss_index,
+        _save_vectorstore,
+    )
+
+    texts = [" ".join(rng.choices(VOCABULARY, k=words_per_doc)) for _ in range(n_docs)]
+    vectors = np.asarray(embedding_function.embed_documents(texts), dtype=np.float32)
+    ids = None
+    if id_mapped:
+        ids = np.asarray(rng.sample(range(2 * n_docs), n_docs), dtype=np.int64)
+    index = _make_faiss_index(vectors, index_params or {}, ids)
+    documents = [
+        Document(page_content=text, metadata={"source": f"doc_{i}.md"})
+        for i, text in enumerate(texts)
+    ]
+    _save_vectorstore(folder_path, index, documents, ids)
+    return texts
+
+
+def make_batch(texts, n_rows, n_unique, history_turns, params, rng):
+    """Prediction data with questions drawn from a pool of `n_unique` questions."""
+    pool = [" ".join(rng.choice(texts).split()[:12]) for _ in range(n_unique)]
+    data: dict[str, list] = {
+        params["prompt_feature_name"]: [rng.choice(pool) for _ in range(n_rows)]
+    }
+    if history_turns:
+        messages = []
+        for question in data[params["prompt_feature_name"]]:
+            history = []
+            for _ in range(history_turns):
+                history.append({"type": "human", "content": question})
+                history.append({"type": "ai", "content": rng.choice(texts)})
+            messages.append(json.dumps(history))
+        data["messages"] = messages
+    return DataFrame(data)
+
+
+def load_config():
+    with open(PARAMETERS_PATH) as f:
+        return yaml.safe_load(f)
+
+
+def load_params(overrides):
+    """Scoring parameters from the project's parameters file plus CLI overrides."""
+    config = load_config()
+
+    def lookup(key):
+        value = config
+        for part in key.split("."):
+            value = value[part]
+        return value
+
+    params: dict[str, Any] = {
+        name: lookup(key) for name, (key, _) in SCORING_PARAMS.items()
+    }
+    llm = config["deploy_custom_rag"]["llm"]
+    params.update(
+        embedding_model_name="fake",
+        azure_endpoint="",
+        openai_api_version="",
+        openai_api_key="",
+        openai_deployment_name="fake",
+        temperature=llm["temperature"],
+        max_retries=llm["max_retries"],
+        request_timeout=llm["request_timeout_secs"],
+        stuff_prompt=llm["stuff_prompt"],
+        prompt_feature_name="promptText",
+        target_feature_name="completion",
+    )
+    for override in overrides:
+        name, value = override.split("=", 1)
+        if name not in params:
+            raise ValueError(f"Unknown parameter {name}")
+        params[name] = yaml.safe_load(value)
+    params["return_stage_metrics"] = True
+    return cast_scoring_params(params)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    params = load_params(args.param)
+    if args.embedding_model:
+        from langchain_community.embeddings.sentence_transformer import (
+            SentenceTransformerEmbeddings,
+        )
+
+        embedding_function = SentenceTransformerEmbeddings(
+            model_name=args.embedding_model
+        )
+    else:
+        embedding_function = DeterministicFakeEmbedding(size=args.embedding_size)
+    llm = FakeChatModel(
+        latency_secs=args.latency_secs,
+        jitter_secs=args.jitter_secs,
+        completion_tokens=args.completion_tokens,
+    )
+
+    with tempfile.TemporaryDirectory() as input_dir:
+        texts = build_fixture(
+            os.path.join(input_dir, "faiss_db"),
+            embedding_function,
+            args.docs,
+            args.words_per_doc,
+            rng,
+            {
+                **load_config()["deploy_custom_rag"]["vectorstore"]["index"],
+                "type": args.index_type,
+            },
+            args.id_mapped,
+        )
+        start = time.perf_counter()
+        model = get_chain(
+            input_dir, llm=llm, embedding_function=embedding_function, **params
+        )
+        load_secs = time.perf_counter() - start
+
+        results, elapsed_secs = [], 0.0
+        for _ in range(args.batches):
+            data = make_batch(
+                texts, args.rows, args.unique_questions, args.history_turns, params, rng
+            )
+            start = time.perf_counter()
+            results.append(score(data, model))
+            elapsed_secs += time.perf_counter() - start
+
+    result = concat(results, ignore_index=True)
+    expected_answer = " ".join(["answer"] * args.completion_tokens)
+    report: dict[str, Any] = {
+        "config": vars(args),
+        "load_secs": load_secs,
+        "rows": len(result),
+        "rows_per_sec": len(result) / elapsed_secs,
+        "failed_rows": int(
+            (result[params["target_feature_name"]] != expected_answer).sum()
+        ),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        "prompt_tokens": int(result["PROMPT_TOKENS"].sum()),
+        "completion_tokens": int(result["COMPLETION_TOKENS"].sum()),
+        "latency_ms": {},
+    }
+    for stage in STAGES:
+        timings = result[f"LATENCY_{stage.upper()}_MS"]
+        timings = timings[timings > 0]
+        if len(timings):
+            p50, p95, p99 = np.percentile(timings, [50, 95, 99])
+            report["latency_ms"][stage] = {
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+                "max": float(timings.max()),
+            }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100, help="Rows per batch")
+    parser.add_argument("--batches", type=int, default=3)
+    parser.add_argument("--unique-questions", type=int, default=50)
+    parser.add_argument("--history-turns", type=int, default=0)
+    parser.add_argument("--docs", type=int, default=2000, help="Corpus size")
+    parser.add_argument("--words-per-doc", type=int, default=300)
+    parser.add_argument("--embedding-size", type=int, default=384)
+    parser.add_argument(
+        "--index-type",
+        default="flat",
+        help="FAISS index type, built with the other index settings of the project",
+    )
+    parser.add_argument(
+        "--id-mapped",
+        action="store_true",
+        help="Search the index by chunk ID, as incremental builds do",
+    )
+    parser.add_argument(
+        "--embedding-model",
+        help="Sentence-transformers model to embed with instead of a fake embedding",
+    )
+    parser.add_argument("--latency-secs", type=float, default=0.5)
+    parser.add_argument("--jitter-secs", type=float, default=0.1)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Override a scoring runtime parameter, e.g. max_concurrency=16",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as json to this path")
+    parser.add_argument(
+        "--baseline", help="Fail if throughput regressed against this report"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed relative throughput drop against the baseline",
+    )
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2, default=str))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        floor = baseline["rows_per_sec"] * (1 - args.tolerance)
+        if report["rows_per_sec"] < floor:
+            print(
+                f"Throughput regressed: {report['rows_per_sec']:.1f} rows/s < "
+                f"{floor:.1f} rows/s ({baseline['rows_per_sec']:.1f} baseline)"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,72 +6,895 @@
 # Released under the terms of DataRobot Tool and Utility Agreement.
 
 
+import contextvars
+import hashlib
 import json
+import math
+import mmap
 import os
+import pickle
+import random
+import resource
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Iterator, Mapping
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable
 
-from langchain.chains import (
-    create_history_aware_retriever,
-    create_retrieval_chain,
-)
+import faiss  # type: ignore
+import httpx
+import numpy as np
+import openai
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_community.callbacks import get_openai_callback
+from langchain_community.docstore.base import Docstore
 from langchain_community.embeddings.sentence_transformer import (
     SentenceTransformerEmbeddings,
 )
 from langchain_community.vectorstores.faiss import FAISS
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import (
     ChatPromptTemplate,
     MessagesPlaceholder,
 )
-from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_core.runnables import Runnable
 from langchain_openai import AzureChatOpenAI
-from pandas import DataFrame  # type: ignore
+from pandas import DataFrame, isna  # type: ignore
+
+# Scoring runtime knobs: DRUM runtime parameter name -> (kedro parameter key, type)
+SCORING_PARAMS = {
+    "max_concurrency": ("deploy_custom_rag.scoring.max_concurrency", int),
+    "max_documents": ("deploy_custom_rag.scoring.max_documents", int),
+    "semantic_cache_enabled": (
+        "deploy_custom_rag.scoring.semantic_cache.enabled",
+        bool,
+    ),
+    "semantic_cache_threshold": (
+        "deploy_custom_rag.scoring.semantic_cache.threshold",
+        float,
+    ),
+    "semantic_cache_max_entries": (
+        "deploy_custom_rag.scoring.semantic_cache.max_entries",
+        int,
+    ),
+    "semantic_cache_ttl_secs": (
+        "deploy_custom_rag.scoring.semantic_cache.ttl_secs",
+        float,
+    ),
+    "response_cache_enabled": (
+        "deploy_custom_rag.scoring.response_cache.enabled",
+        bool,
+    ),
+    "response_cache_max_entries": (
+        "deploy_custom_rag.scoring.response_cache.max_entries",
+        int,
+    ),
+    "shared_state_dir": ("deploy_custom_rag.scoring.shared_state_dir", str),
+    "faiss_load_mode": ("deploy_custom_rag.scoring.faiss_load_mode", str),
+    "embedding_backend": ("deploy_custom_rag.vectorstore.embedding_backend", str),
+    "return_stage_metrics": ("deploy_custom_rag.scoring.return_stage_metrics", bool),
+    "arrow_output": ("deploy_custom_rag.scoring.arrow_output", bool),
+    "context_packing_enabled": (
+        "deploy_custom_rag.scoring.context_packing.enabled",
+        bool,
+    ),
+    "context_token_budget": (
+        "deploy_custom_rag.scoring.context_packing.token_budget",
+        int,
+    ),
+    "context_dedupe_threshold": (
+        "deploy_custom_rag.scoring.context_packing.dedupe_threshold",
+        float,
+    ),
+    "http_pool_size": ("deploy_custom_rag.llm.http.pool_size", int),
+    "http_keepalive_secs": ("deploy_custom_rag.llm.http.keepalive_secs", float),
+    "http2": ("deploy_custom_rag.llm.http.http2", bool),
+    "rate_limit_tokens_per_minute": (
+        "deploy_custom_rag.llm.rate_limit.tokens_per_minute",
+        float,
+    ),
+    "rate_limit_requests_per_minute": (
+        "deploy_custom_rag.llm.rate_limit.requests_per_minute",
+        float,
+    ),
+    "expected_completion_tokens": (
+        "deploy_custom_rag.llm.rate_limit.expected_completion_tokens",
+        int,
+    ),
+    "hedge_enabled": ("deploy_custom_rag.llm.hedge.enabled", bool),
+    "hedge_percentile": ("deploy_custom_rag.llm.hedge.percentile", float),
+    "hedge_min_delay_secs": ("deploy_custom_rag.llm.hedge.min_delay_secs", float),
+    "hedge_deployment_name": ("deploy_custom_rag.llm.hedge.deployment_name", str),
+    "hedge_azure_endpoint": ("deploy_custom_rag.llm.hedge.azure_endpoint", str),
+    "retry_max_attempts": ("deploy_custom_rag.llm.retry.max_attempts", int),
+    "retry_budget_ratio": ("deploy_custom_rag.llm.retry.budget_ratio", float),
+    "retry_rate_limit_delay_secs": (
+        "deploy_custom_rag.llm.retry.rate_limit_delay_secs",
+        float,
+    ),
+    "retry_timeout_delay_secs": (
+        "deploy_custom_rag.llm.retry.timeout_delay_secs",
+        float,
+    ),
+    "retry_server_error_delay_secs": (
+        "deploy_custom_rag.llm.retry.server_error_delay_secs",
+        float,
+    ),
+    "retry_max_delay_secs": ("deploy_custom_rag.llm.retry.max_delay_secs", float),
+    "deadline_secs": ("deploy_custom_rag.scoring.deadline_secs", float),
+    "retrieval_only": ("deploy_custom_rag.scoring.retrieval_only", bool),
+    "coalesce_duplicates": ("deploy_custom_rag.scoring.coalesce_duplicates", bool),
+    "history_max_turns": ("deploy_custom_rag.scoring.chat_history.max_turns", int),
+    "history_max_tokens": ("deploy_custom_rag.scoring.chat_history.max_tokens", int),
+    "history_condense": ("deploy_custom_rag.scoring.chat_history.condense", bool),
+    "history_summary_cache_entries": (
+        "deploy_custom_rag.scoring.chat_history.summary_cache_entries",
+        int,
+    ),
+}
+
+# Scoring stages timed per row by `score`
+STAGES = (
+    "cache",
+    "coalesce",
+    "condense",
+    "contextualize",
+    "embedding",
+    "search",
+    "throttle",
+    "answer",
+)
+
+CONTEXTUALIZE_Q_SYSTEM_PROMPT = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, just "
+    "reformulate it if needed and otherwise return it as is."
+)
+
+CONDENSE_HISTORY_SYSTEM_PROMPT = (
+    "Summarize the conversation below in a few sentences. Keep the facts, names "
+    "and open questions needed to understand follow-up questions. If it starts "
+    "with a summary of an earlier part of the conversation, fold that summary in. "
+    "Return only the summary."
+)
+
+HISTORY_SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+class SemanticCache:
+    """Thread-safe in-memory answer cache keyed by question embedding similarity.
+
+    An entry matches a lookup when its context key (a hash of the chat history and
+    generation parameters) is identical and the cosine similarity between the
+    question embeddings is at least `threshold`. Entries are evicted least recently
+    used first once `max_entries` is reached and expire after `ttl_secs`.
+    """
+
+    def __init__(self, threshold: float, max_entries: int, ttl_secs: float):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[int, tuple[str, np.ndarray, Any, float]] = (
+            OrderedDict()
+        )
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _expire(self, now: float) -> None:
+        # Entries are kept in recency order for LRU eviction, so a hit moves an
+        # old entry behind newer ones: expired entries can sit anywhere.
+        expired = [
+            entry_id
+            for entry_id, (_, _, _, created) in self._entries.items()
+            if now - created > self.ttl_secs
+        ]
+        for entry_id in expired:
+            del self._entries[entry_id]
+
+    def get(self, context_key: str, vector) -> Any | None:
+        """Return the cached value for the most similar matching question, if any."""
+        vector = self._normalize(vector)
+        with self._lock:
+            self._expire(time.monotonic())
+            candidates = [
+                (entry_id, entry_vector)
+                for entry_id, (key, entry_vector, _, _) in self._entries.items()
+                if key == context_key
+            ]
+            if candidates:
+                similarities = np.stack([v for _, v in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id = candidates[best][0]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return self._entries[entry_id][2]
+            self.misses += 1
+            return None
+
+    def put(self, context_key: str, vector, value: Any) -> None:
+        """Cache `value` for a question embedding, evicting the oldest entries."""
+        vector = self._normalize(vector)
+        with self._lock:
+            entry = (context_key, vector, value, time.monotonic())
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class HistorySummaryCache:
+    """Thread-safe in-memory LRU cache of chat history summaries by history hash."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            summary = self._entries.get(key)
+            if summary is not None:
+                self._entries.move_to_end(key)
+            return summary
+
+    def put(self, key: str, summary: str) -> None:
+        with self._lock:
+            self._entries[key] = summary
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ResponseCache:
+    """Persistent exact-match cache of answers and citations backed by SQLite.
+
+    The database lives in a directory on the container's filesystem so it is
+    shared by every DRUM worker in the container. Entries are evicted least
+    recently used first once `max_entries` is exceeded.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access "
+            "ON responses (last_access)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> tuple[str, list[Document], list] | None:
+        """Return the cached answer, citations and their scores for `key`, if any."""
+        with self._lock:
+            record = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if record is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._conn.commit()
+            self.hits += 1
+        value = json.loads(record[0])
+        context = [Document(**doc) for doc in value["context"]]
+        # Entries written before scores were cached have none
+        scores = value.get("scores", [None] * len(context))
+        return value["answer"], context, scores
+
+    def put(self, key: str, answer: str, context: list[Document], scores: list) -> None:
+        """Store an answer, its citations and their scores, evicting the oldest."""
+        value = json.dumps(
+            {
+                "answer": answer,
+                "context": [
+                    {"page_content": doc.page_content, "metadata": doc.metadata}
+                    for doc in context
+                ],
+                "scores": [None if score is None else float(score) for score in scores],
+            }
+        )
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                "ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+
+class ColumnarDocstore(Docstore):
+    """Read-only docstore over the packed json records written at build time.
+
+    `docstore.bin` holds one json record per indexed vector and
+    `docstore_offsets.npy` their byte offsets. Both are memory-mapped, so startup
+    does not depend on corpus size and only retrieved documents are materialized.
+    Documents are looked up by their position in the FAISS index.
+    """
+
+    def __init__(self, folder_path: str):
+        self._offsets = np.load(
+            os.path.join(folder_path, "docstore_offsets.npy"), mmap_mode="r"
+        )
+        with open(os.path.join(folder_path, "docstore.bin"), "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def search(self, search: int | str) -> Document:
+        i = int(search)
+        record = json.loads(self._data[self._offsets[i] : self._offsets[i + 1]])
+        return Document(
+            page_content=record["page_content"], metadata=record["metadata"]
+        )
+
+
+class SortedIdMap(Mapping):
+    """Maps the chunk IDs of an ID-mapped FAISS index to docstore positions.
+
+    Stands in for the `index_to_docstore_id` dict with two integer arrays, the
+    IDs in ascending order and their positions, looked up by binary search.
+    """
+
+    def __init__(self, ids: np.ndarray):
+        self._order = np.argsort(ids, kind="stable")
+        self._ids = ids[self._order]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(i) for i in self._ids)
+
+    def __getitem__(self, key: int) -> int:
+        i = int(np.searchsorted(self._ids, key))
+        if i == len(self._ids) or self._ids[i] != key:
+            raise KeyError(key)
+        return int(self._order[i])
+
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence-transformer embeddings computed with onnxruntime instead of torch.
+
+    Loads the model exported by the deploy_custom_rag pipeline along with its
+    tokenizer and pooling configuration.
+    """
+
+    def __init__(self, folder_path: str, batch_size: int = 32):
+        import onnxruntime  # type: ignore
+        from tokenizers import Tokenizer  # type: ignore
+
+        with open(os.path.join(folder_path, "embedding_config.json")) as f:
+            self._config = json.load(f)
+        self._tokenizer = Tokenizer.from_file(
+            os.path.join(folder_path, "tokenizer.json")
+        )
+        self._tokenizer.enable_truncation(max_length=self._config["max_seq_length"])
+        self._tokenizer.enable_padding(
+            pad_id=self._config["pad_token_id"], pad_token=self._config["pad_token"]
+        )
+        self._session = onnxruntime.InferenceSession(
+            os.path.join(folder_path, "model.onnx"),
+            providers=["CPUExecutionProvider"],
+        )
+        self._batch_size = batch_size
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        encodings = self._tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        (hidden,) = self._session.run(
+            None, {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+        if self._config["pooling"] == "cls":
+            vectors = hidden[:, 0]
+        else:
+            mask = attention_mask[..., None].astype(hidden.dtype)
+            vectors = (hidden * mask).sum(axis=1) / np.clip(
+                mask.sum(axis=1), 1e-9, None
+            )
+        if self._config["normalize"]:
+            vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return np.concatenate(
+            [
+                self._encode(texts[i : i + self._batch_size])
+                for i in range(0, len(texts), self._batch_size)
+            ]
+        ).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+class RateLimiter:
+    """Client-side token buckets for an Azure OpenAI deployment's TPM and RPM quotas.
+
+    Each call reserves its estimated tokens and one request up front. When a bucket
+    runs dry the caller sleeps until the reservation is covered by the refill rate,
+    so bursts are queued in arrival order instead of being rejected by Azure.
+    Buckets hold at most 10 seconds of quota, the window Azure enforces its
+    per-minute limits over. A limit of 0 disables its bucket.
+
+    With `path`, the bucket levels live in a SQLite database under `key` and are
+    updated in a write transaction, so every DRUM worker in the container draws on
+    the same buckets and together they stay within the deployment's quota.
+    Without it, the buckets are private to this process.
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: float,
+        requests_per_minute: float,
+        path: str | None = None,
+        key: str = "",
+    ):
+        self._limits = {"tokens": tokens_per_minute, "requests": requests_per_minute}
+        self._levels = {name: limit / 6 for name, limit in self._limits.items()}
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._key = key
+        self._conn = None
+        if path is not None:
+            # Transactions are managed explicitly in _buckets
+            self._conn = sqlite3.connect(
+                path, timeout=30, check_same_thread=False, isolation_level=None
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets "
+                "(key TEXT PRIMARY KEY, levels TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _buckets(self):
+        """Hold the buckets, refilled up to now, saving their levels on exit."""
+        with self._lock:
+            if self._conn is None:
+                self._refill()
+                yield
+                return
+            # Takes the database write lock, serializing workers until COMMIT
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                record = self._conn.execute(
+                    "SELECT levels, updated FROM rate_limit_buckets WHERE key = ?",
+                    (self._key,),
+                ).fetchone()
+                if record is not None:
+                    self._levels = {**self._levels, **json.loads(record[0])}
+                    self._updated = record[1]
+                self._refill()
+                yield
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_limit_buckets VALUES (?, ?, ?)",
+                    (self._key, json.dumps(self._levels), self._updated),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _refill(self) -> None:
+        # The monotonic clock is system-wide, so it is comparable across workers
+        now = time.monotonic()
+        elapsed, self._updated = max(0.0, now - self._updated), now
+        for name, limit in self._limits.items():
+            if limit > 0:
+                self._levels[name] = min(
+                    limit / 6, self._levels[name] + elapsed * limit / 60
+                )
 
+    def _amounts(self, tokens: int) -> list[tuple[str, float]]:
+        return [
+            (name, min(amount, self._limits[name] / 6))
+            for name, amount in [("tokens", tokens), ("requests", 1)]
+            if self._limits[name] > 0
+        ]
+
+    def acquire(self, tokens: int) -> float:
+        """Block until `tokens` tokens and one request fit the quota.
+
+        Returns the number of seconds waited.
+        """
+        with self._buckets():
+            wait = 0.0
+            for name, amount in self._amounts(tokens):
+                self._levels[name] -= amount
+                if self._levels[name] < 0:
+                    wait = max(wait, -self._levels[name] * 60 / self._limits[name])
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Reserve `tokens` tokens and one request only if they fit the quota now."""
+        with self._buckets():
+            amounts = self._amounts(tokens)
+            if any(self._levels[name] < amount for name, amount in amounts):
+                return False
+            for name, amount in amounts:
+                self._levels[name] -= amount
+            return True
+
+
+class Hedger:
+    """Hedges slow answer calls with a duplicate call to a secondary deployment.
+
+    If the primary call has not returned after the `percentile` of recent primary
+    latencies (never less than `min_delay_secs`), the same request is sent to the
+    secondary chain and whichever succeeds first is used. The losing call is left
+    to finish in the background. With a `rate_limiter`, a hedge is only sent if
+    the quota covers it right away; otherwise the call keeps waiting on the
+    primary. `fired`, `won` and `skipped` count hedges sent, hedges that beat the
+    primary and hedges skipped for lack of quota.
+    """
+
+    min_samples = 20
+
+    def __init__(
+        self,
+        secondary_chain: Runnable,
+        percentile: float,
+        min_delay_secs: float,
+        max_workers: int,
+        window: int = 200,
+        rate_limiter: RateLimiter | None = None,
+    ):
+        self.secondary_chain = secondary_chain
+        self.percentile = percentile
+        self.min_delay_secs = min_delay_secs
+        self.rate_limiter = rate_limiter
+        self.fired = 0
+        self.won = 0
+        self.skipped = 0
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def delay(self) -> float:
+        """Seconds to wait on the primary call before hedging."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.min_delay_secs
+            latency = float(np.percentile(self._latencies, self.percentile))
+        return max(self.min_delay_secs, latency)
+
+    def _record(self, start: float) -> None:
+        with self._lock:
+            self._latencies.append(time.perf_counter() - start)
+
+    def _submit(self, chain, inputs):
+        # Run in a copy of the caller's context so token usage callbacks still apply
+        return self._executor.submit(
+            contextvars.copy_context().run, chain.invoke, inputs
+        )
+
+    def invoke(
+        self, primary_chain: Runnable, inputs: dict[str, Any], tokens: int = 0
+    ) -> Any:
+        """Invoke the primary chain, hedging it with a call estimated at `tokens`."""
+        start = time.perf_counter()
+        primary = self._submit(primary_chain, inputs)
+        primary.add_done_callback(lambda _: self._record(start))
+        try:
+            return primary.result(timeout=self.delay())
+        except FuturesTimeoutError:
+            pass
+
+        if self.rate_limiter is not None and not self.rate_limiter.try_acquire(tokens):
+            with self._lock:
+                self.skipped += 1
+            return primary.result()
+        secondary = self._submit(self.secondary_chain, inputs)
+        with self._lock:
+            self.fired += 1
+        pending = {primary, secondary}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # Both calls may finish together; prefer whichever succeeded
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded:
+                # The primary wins ties, it needed no extra call
+                future = primary if primary in succeeded else succeeded[0]
+                if future is secondary:
+                    with self._lock:
+                        self.won += 1
+                return future.result()
+        # Both calls failed, report the primary's error
+        return primary.result()
+
+
+class InFlightRequests:
+    """Rows currently being scored by any `score` call, keyed by their inputs.
+
+    The first call to claim a key owns it and publishes its result on release;
+    concurrent calls claiming the same key wait on that result instead of
+    scoring the row again.
+    """
 
-def get_chain(input_dir, **params):
-    """Instantiate the RAG chain."""
-    embedding_function = SentenceTransformerEmbeddings(
-        model_name=params["embedding_model_name"],
-        cache_folder=input_dir + "/sentencetransformers",
+    def __init__(self):
+        self._futures: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def claim(self, key):
+        """Return the future for `key` and whether the caller owns it."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._futures[key] = Future()
+            return future, True
+
+    def release(self, key, future, result):
+        with self._lock:
+            del self._futures[key]
+        future.set_result(result)
+
+
+@dataclass
+class RagModel:
+    """Loaded state of the RAG model.
+
+    Retrieval is run by `score` for a whole batch at once, so the model keeps
+    the contextualize and answer chains separate from the vectorstore instead
+    of composing them into a single retrieval chain.
+    """
+
+    contextualize_chain: Runnable
+    answer_chain: Runnable
+    vectorstore: FAISS
+    params: dict[str, Any]
+    count_tokens: Callable[[str], int]
+    semantic_cache: SemanticCache | None = None
+    response_cache: ResponseCache | None = None
+    rate_limiter: RateLimiter | None = None
+    hedger: Hedger | None = None
+    in_flight: InFlightRequests | None = None
+    condense_chain: Runnable | None = None
+    history_summaries: HistorySummaryCache | None = None
+    vectorstore_fingerprint: str = ""
+
+
+def _rss_mb():
+    """Current resident set size of this process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        # Peak rather than current RSS, but the best available outside of linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def _smaps_rollup():
+    """Memory totals of this process in MB by smaps field, empty outside of linux."""
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[name] = int(value.split()[0]) / 2**10
+    except OSError:
+        return {}
+    return fields
+
+
+def _memory_report():
+    """Resident, unique (private to this process) and shared memory in MB.
+
+    Unique memory is what each additional worker costs; shared pages, such as
+    the memory-mapped index, are only paid for once.
+    """
+    fields = _smaps_rollup()
+    if not fields:
+        return f"RSS {_rss_mb():.0f}MB"
+    unique = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    shared = fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+    return (
+        f"RSS {fields.get('Rss', 0):.0f}MB, unique {unique:.0f}MB, "
+        f"shared {shared:.0f}MB, PSS {fields.get('Pss', 0):.0f}MB"
     )
-    db = FAISS.load_local(
-        folder_path=input_dir + "/faiss_db",
-        embeddings=embedding_function,
-        allow_dangerous_deserialization=True,
+
+
+def _vectorstore_fingerprint(folder_path):
+    """Hash identifying a saved vectorstore, cheap enough to compute at load time.
+
+    Covers the name and size of every file and the contents of the docstore
+    offsets and chunk IDs, which change whenever the indexed chunks do.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(folder_path)):
+        path = os.path.join(folder_path, name)
+        digest.update(f"{name}:{os.path.getsize(path)}\n".encode())
+        if name in ("docstore_offsets.npy", "docstore_ids.npy"):
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def load_vectorstore(folder_path, embedding_function, load_mode="memory"):
+    """Load the FAISS vectorstore saved by the deploy_custom_rag pipeline.
+
+    With `load_mode="mmap"` the index file is memory-mapped read-only instead of
+    being read into the heap, so DRUM workers in the same container share its pages
+    through the OS page cache. This relies on faiss 1.11 or later, which maps the
+    codes of flat, quantized and HNSW indexes as well as IVF inverted lists. A
+    warning is printed when most of the index still ends up in private memory.
+    Index types faiss cannot map fall back to a regular read. Vectorstores saved
+    before the columnar docstore was introduced are loaded from their pickled
+    docstore.
+    """
+    start, rss_before = time.perf_counter(), _rss_mb()
+    index_path = os.path.join(folder_path, "index.faiss")
+    if load_mode == "mmap":
+        anonymous_before = _smaps_rollup().get("Anonymous")
+        io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP_IFC
+        try:
+            index = faiss.read_index(index_path, io_flags)
+        except RuntimeError as e:
+            print(f"Unable to memory-map {index_path}: {e}. Reading it instead.")
+            index = faiss.read_index(index_path)
+        anonymous_after = _smaps_rollup().get("Anonymous")
+        if anonymous_before is not None and anonymous_after is not None:
+            private_mb = anonymous_after - anonymous_before
+            if private_mb > os.path.getsize(index_path) / 2**20 / 2:
+                print(
+                    f"Warning: {index_path} is not file-backed, {private_mb:.0f}MB "
+                    "of it was read into private memory of this process"
+                )
+    else:
+        index = faiss.read_index(index_path)
+
+    if os.path.exists(os.path.join(folder_path, "docstore_ids.npy")):
+        # Index built incrementally, searching returns chunk IDs
+        docstore = ColumnarDocstore(folder_path)
+        ids = np.load(os.path.join(folder_path, "docstore_ids.npy"))
+        index_to_docstore_id = SortedIdMap(ids)
+    elif os.path.exists(os.path.join(folder_path, "docstore.bin")):
+        docstore = ColumnarDocstore(folder_path)
+        # Index positions are docstore positions
+        index_to_docstore_id = range(len(docstore))
+    else:
+        with open(os.path.join(folder_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    db = FAISS(embedding_function, index, docstore, index_to_docstore_id)
+    print(
+        f"Loaded {folder_path} ({load_mode}) in {time.perf_counter() - start:.2f}s, "
+        f"RSS {rss_before:.0f}MB -> {_rss_mb():.0f}MB"
     )
-    llm = AzureChatOpenAI(
-        deployment_name=params["openai_deployment_name"],
-        azure_endpoint=params["azure_endpoint"],
+    return db
+
+
+def _make_token_counter():
+    """Count prompt tokens with tiktoken, or estimate them if it is unavailable."""
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        print(f"Unable to load tiktoken encoding: {e}. Estimating 4 chars per token.")
+        return lambda text: len(text) // 4 + 1
+
+
+def _make_http_client(params):
+    """Pooled keep-alive HTTP client shared by every Azure OpenAI call of the model.
+
+    The pool is at least as large as the number of concurrently scored rows so
+    connections (and their TLS sessions) are reused rather than re-established.
+    """
+    http2 = params["http2"]
+    if http2:
+        try:
+            import h2  # type: ignore # noqa: F401
+        except ImportError:
+            print("HTTP/2 requested but h2 is not installed, using HTTP/1.1")
+            http2 = False
+    pool_size = max(params["http_pool_size"], params["max_concurrency"])
+    return httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=params["http_keepalive_secs"],
+        ),
+        timeout=params["request_timeout"],
+    )
+
+
+def _make_llm(params, http_client, deployment_name, azure_endpoint):
+    return AzureChatOpenAI(
+        deployment_name=deployment_name,
+        azure_endpoint=azure_endpoint,
         openai_api_version=params["openai_api_version"],
         openai_api_key=params["openai_api_key"],
-        model_name=params["openai_deployment_name"],
+        model_name=deployment_name,
         temperature=params["temperature"],
         verbose=True,
         max_retries=params["max_retries"],
         request_timeout=params["request_timeout"],
+        http_client=http_client,
     )
-    retriever = VectorStoreRetriever(
-        vectorstore=db,
+
+
+def get_chain(input_dir, llm=None, embedding_function=None, **params):
+    """Instantiate the RAG chain components.
+
+    `llm` and `embedding_function` default to the Azure OpenAI deployment and
+    embedding model configured in `params`; passing them in allows running the
+    model offline, as benchmark.py does.
+    """
+    if embedding_function is None and params["embedding_backend"] == "onnx":
+        embedding_function = OnnxEmbeddings(input_dir + "/onnx_embeddings")
+    elif embedding_function is None:
+        embedding_function = SentenceTransformerEmbeddings(
+            model_name=params["embedding_model_name"],
+            cache_folder=input_dir + "/sentencetransformers",
+        )
+    db = load_vectorstore(
+        input_dir + "/faiss_db", embedding_function, params["faiss_load_mode"]
     )
+    http_client = None
+    if llm is None:
+        http_client = _make_http_client(params)
+        llm = _make_llm(
+            params,
+            http_client,
+            params["openai_deployment_name"],
+            params["azure_endpoint"],
+        )
     system_template = params["stuff_prompt"]
-    contextualize_q_system_prompt = (
-        "Given a chat history and the latest user question "
-        "which might reference context in the chat history, "
-        "formulate a standalone question which can be understood "
-        "without the chat history. Do NOT answer the question, just "
-        "reformulate it if needed and otherwise return it as is."
-    )
     contextualize_q_prompt = ChatPromptTemplate.from_messages(
         [
-            ("system", contextualize_q_system_prompt),
+            ("system", CONTEXTUALIZE_Q_SYSTEM_PROMPT),
             MessagesPlaceholder("chat_history"),
             ("human", "{input}"),
         ]
     )
-    history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
-    )
+    # Equivalent to the question-rewriting half of create_history_aware_retriever;
+    # the retrieval half is batched in `_retrieve_batch`.
+    contextualize_chain = contextualize_q_prompt | llm | StrOutputParser()
 
     # Answer question
     qa_system_prompt = system_template
@@ -86,8 +909,103 @@ def get_chain(input_dir, **params):
     # into the LLM. Note that we can also use StuffDocumentsChain and other
     # instances of BaseCombineDocumentsChain.
     question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-    return rag_chain
+    condense_chain = None
+    history_summaries = None
+    if params["history_condense"]:
+        condense_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", CONDENSE_HISTORY_SYSTEM_PROMPT),
+                MessagesPlaceholder("chat_history"),
+                ("human", "Summarize the conversation above."),
+            ]
+        )
+        condense_chain = condense_prompt | llm | StrOutputParser()
+        history_summaries = HistorySummaryCache(
+            max_entries=params["history_summary_cache_entries"]
+        )
+    semantic_cache = None
+    if params["semantic_cache_enabled"]:
+        semantic_cache = SemanticCache(
+            threshold=params["semantic_cache_threshold"],
+            max_entries=params["semantic_cache_max_entries"],
+            ttl_secs=params["semantic_cache_ttl_secs"],
+        )
+    response_cache = None
+    if params["response_cache_enabled"]:
+        path = os.path.join(
+            params["shared_state_dir"] or tempfile.gettempdir(),
+            "response_cache.sqlite",
+        )
+        try:
+            response_cache = ResponseCache(
+                path=path, max_entries=params["response_cache_max_entries"]
+            )
+        except (sqlite3.Error, OSError) as e:
+            print(f"Response cache disabled, cannot open {path}: {e}")
+    rate_limiter = None
+    if (
+        params["rate_limit_tokens_per_minute"]
+        or params["rate_limit_requests_per_minute"]
+    ):
+        limits = {
+            "tokens_per_minute": params["rate_limit_tokens_per_minute"],
+            "requests_per_minute": params["rate_limit_requests_per_minute"],
+        }
+        path = os.path.join(
+            params["shared_state_dir"] or tempfile.gettempdir(), "rate_limit.sqlite"
+        )
+        try:
+            rate_limiter = RateLimiter(
+                **limits,
+                path=path,
+                key=f"{params['azure_endpoint']}/{params['openai_deployment_name']}",
+            )
+        except (sqlite3.Error, OSError) as e:
+            print(
+                f"Cannot open {path}: {e}. Rate limits apply to each worker "
+                "separately."
+            )
+            rate_limiter = RateLimiter(**limits)
+    hedger = None
+    if params["hedge_enabled"]:
+        secondary_llm = llm
+        if http_client is not None:
+            secondary_llm = _make_llm(
+                params,
+                http_client,
+                params["hedge_deployment_name"] or params["openai_deployment_name"],
+                params["hedge_azure_endpoint"] or params["azure_endpoint"],
+            )
+        hedger = Hedger(
+            secondary_chain=create_stuff_documents_chain(secondary_llm, qa_prompt),
+            percentile=params["hedge_percentile"],
+            min_delay_secs=params["hedge_min_delay_secs"],
+            max_workers=2 * max(1, params["max_concurrency"]),
+            rate_limiter=rate_limiter,
+        )
+    return RagModel(
+        contextualize_chain=contextualize_chain,
+        answer_chain=question_answer_chain,
+        vectorstore=db,
+        params=params,
+        count_tokens=_make_token_counter(),
+        semantic_cache=semantic_cache,
+        response_cache=response_cache,
+        rate_limiter=rate_limiter,
+        hedger=hedger,
+        in_flight=InFlightRequests() if params["coalesce_duplicates"] else None,
+        condense_chain=condense_chain,
+        history_summaries=history_summaries,
+        vectorstore_fingerprint=_vectorstore_fingerprint(input_dir + "/faiss_db"),
+    )
+
+
+def cast_scoring_params(params):
+    """Convert scoring parameters to their declared types, in place."""
+    for name, (_, cast) in SCORING_PARAMS.items():
+        # Unset runtime parameters come back as None; use the type's zero value
+        params[name] = cast(params[name]) if params[name] is not None else cast()
+    return params
 
 
 def load_model(input_dir):
@@ -114,6 +1032,8 @@ def load_model(input_dir):
         params["openai_api_key"] = RuntimeParameters.get(params["dr_credential_name"])[
             "apiToken"
         ]
+        for name in SCORING_PARAMS:
+            params[name] = RuntimeParameters.get(name)
     except ValueError as e:
         print(f"Error loading runtime parameters: {e}. Defaulting to local run mode.")
         from local_helpers import get_kedro_catalog
@@ -148,65 +1068,809 @@ def load_model(input_dir):
         params["stuff_prompt"] = catalog.load(
             "params:deploy_custom_rag.llm.stuff_prompt"
         )
+        for name, (key, _) in SCORING_PARAMS.items():
+            params[name] = catalog.load(f"params:{key}")
 
-    chain = get_chain(input_dir, **params)
-    return chain, params["prompt_feature_name"], params["target_feature_name"]
+    cast_scoring_params(params)
+    model = get_chain(input_dir, **params)
+    print(f"Model loaded in worker {os.getpid()}: {_memory_report()}")
+    return model
 
 
-def score(data, model, **kwargs):
-    """ "Orchestrate a RAG completion with our vector database."""
-    chain, prompt_feature_name, target_feature_name = model
-
-    full_result_dict: dict[str, list] = {target_feature_name: []}
-
-    for i, row in data.iterrows():
-        question = row[prompt_feature_name]
-        chat_history = []
-        if "messages" in row:
-            messages = row["messages"]
-            messages = json.loads(messages)
-            for ia, a in enumerate(messages):
-                message_dict = a
-                if message_dict["type"] == "human":
-                    message = HumanMessage.validate(message_dict)
-                else:
-                    message = AIMessage.validate(message_dict)
-                chat_history.append(message)
+def _parse_chat_history(row):
+    """Convert the optional `messages` json column into langchain messages."""
+    chat_history = []
+    if "messages" in row:
+        messages = json.loads(row["messages"])
+        for message_dict in messages:
+            if message_dict["type"] == "human":
+                message = HumanMessage.validate(message_dict)
+            else:
+                message = AIMessage.validate(message_dict)
+            chat_history.append(message)
+    return chat_history
+
+
+def _parse_retrieval_only(row, default):
+    """Read the optional per-row `retrieval_only` flag, falling back to `default`."""
+    value = row.get("retrieval_only")
+    if value is None or isna(value):
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes")
+    return bool(value)
+
+
+@dataclass
+class _Row:
+    """Intermediate state of a single row as it moves through the scoring stages."""
+
+    question: str
+    chat_history: list
+    retrieval_only: bool = False
+    context_key: str = ""
+    key: str = ""
+    standalone_question: str = ""
+    question_embedding: Any = None
+    embedding: Any = None
+    context: list = field(default_factory=list)
+    scores: list = field(default_factory=list)
+    answer: str = ""
+    error: str | None = None
+    cached: bool = False
+    coalesced: bool = False
+    in_flight: Future | None = None
+    timings: dict[str, float] = field(default_factory=dict)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+
+
+class DeadlineExceeded(Exception):
+    """Raised for rows that did not finish before the batch deadline."""
+
+
+class _Batch:
+    """Deadline and retry budget shared by all rows of one `score` call."""
+
+    def __init__(self, n_rows, params):
+        self.deadline_secs = params["deadline_secs"]
+        self.deadline = (
+            time.monotonic() + self.deadline_secs if self.deadline_secs > 0 else None
+        )
+        self._retries_left = math.ceil(params["retry_budget_ratio"] * n_rows)
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """Seconds left before the deadline, or None without a deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check_deadline(self):
+        if self.remaining() == 0.0:
+            raise DeadlineExceeded(
+                f"batch deadline of {self.deadline_secs:g}s exceeded"
+            )
 
+    def take_retry(self):
+        """Consume one retry from the batch budget, if any is left."""
+        with self._lock:
+            if self._retries_left <= 0:
+                return False
+            self._retries_left -= 1
+            return True
+
+
+@contextmanager
+def _timed(rows, stage):
+    """Add the wall-clock time of the block, in ms, to `stage` of every row.
+
+    Batched stages pass all rows of the batch, so each row is charged the full
+    time it spent waiting on the batch.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        for row in rows:
+            row.timings[stage] = row.timings.get(stage, 0.0) + elapsed_ms
+
+
+def _estimate_tokens(model, row, *texts):
+    """Estimate the tokens an LLM call will consume, including its completion."""
+    return (
+        sum(model.count_tokens(str(m.content)) for m in row.chat_history)
+        + sum(model.count_tokens(text) for text in texts)
+        + model.params["expected_completion_tokens"]
+    )
+
+
+def _retry_delay(params, error):
+    """Base backoff delay for a transient error, or None if it should not be retried."""
+    if isinstance(error, openai.RateLimitError):
+        return params["retry_rate_limit_delay_secs"]
+    if isinstance(error, (openai.APITimeoutError, httpx.TimeoutException)):
+        return params["retry_timeout_delay_secs"]
+    if isinstance(error, openai.APIConnectionError) or (
+        isinstance(error, openai.APIStatusError) and error.status_code >= 500
+    ):
+        return params["retry_server_error_delay_secs"]
+    return None
+
+
+def _retry_after(error):
+    """Delay in seconds requested by the error's retry-after(-ms) header, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    for header, scale in [("retry-after-ms", 1000.0), ("retry-after", 1.0)]:
+        value = response.headers.get(header)
+        if value is None:
+            continue
         try:
-            with get_openai_callback():
-                chain_output = chain.invoke(
-                    {
-                        "input": question,
-                        "chat_history": chat_history,
-                    }
+            return float(value) / scale
+        except ValueError:
+            # Retry-After may also be an HTTP date, which is not honoured
+            continue
+    return None
+
+
+def _tracked_call(row, stage, call):
+    """Time a single LLM call and record its token usage on the row."""
+    with _timed([row], stage), get_openai_callback() as cb:
+        try:
+            return call()
+        finally:
+            row.prompt_tokens += cb.prompt_tokens
+            row.completion_tokens += cb.completion_tokens
+
+
+def _invoke_llm(model, batch, row, stage, estimated_tokens, call):
+    """Throttle, time and record the token usage of an LLM call, retrying it.
+
+    Transient errors are retried up to `retry_max_attempts` times with full-jitter
+    exponential backoff whose base depends on the error class, honouring
+    Retry-After and retry-after-ms headers. Every retry draws on the batch's retry
+    budget and is only attempted if its backoff ends before the batch deadline.
+    """
+    for attempt in range(max(1, model.params["retry_max_attempts"])):
+        if model.rate_limiter is not None:
+            with _timed([row], "throttle"):
+                model.rate_limiter.acquire(estimated_tokens)
+        try:
+            return _tracked_call(row, stage, call)
+        except Exception as e:
+            base_delay = _retry_delay(model.params, e)
+            if (
+                base_delay is None
+                or attempt + 1 >= model.params["retry_max_attempts"]
+                or not batch.take_retry()
+            ):
+                raise
+            delay = random.uniform(
+                0, min(model.params["retry_max_delay_secs"], base_delay * 2**attempt)
+            )
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            remaining = batch.remaining()
+            if remaining is not None and delay >= remaining:
+                raise
+            row.retries += 1
+            time.sleep(delay)
+
+
+def _pending(rows):
+    """Rows that have neither failed nor been answered from a cache or another row."""
+    return [
+        row
+        for row in rows
+        if row.error is None and not row.cached and not row.coalesced
+    ]
+
+
+def _answered(rows):
+    """Rows that need an answer from the LLM rather than citations only."""
+    return [row for row in rows if not row.retrieval_only]
+
+
+def _format_error(e):
+    return f"{e.__class__.__name__}: {str(e)}"
+
+
+def _run_stage(executor, batch, rows, func):
+    """Apply `func` to every pending row, capturing errors per row.
+
+    Rows still running or queued when the batch deadline passes are marked as
+    failed and no longer waited on.
+    """
+
+    def _apply(row):
+        try:
+            batch.check_deadline()
+            func(row)
+        except Exception as e:
+            row.error = _format_error(e)
+
+    futures = {executor.submit(_apply, row): row for row in _pending(rows)}
+    _, not_done = wait(futures, timeout=batch.remaining())
+    for future in not_done:
+        future.cancel()
+        futures[future].error = _format_error(
+            DeadlineExceeded(f"batch deadline of {batch.deadline_secs:g}s exceeded")
+        )
+
+
+def _embed(vectorstore, texts):
+    """Embed `texts` with a single call to the vectorstore's embedding model."""
+    return np.asarray(vectorstore.embeddings.embed_documents(texts), dtype=np.float32)
+
+
+def _context_key(model, row):
+    """Hash of everything besides the question that determines the answer."""
+    payload = {
+        "chat_history": [(m.type, m.content) for m in row.chat_history],
+        "stuff_prompt": model.params["stuff_prompt"],
+        "deployment": model.params["openai_deployment_name"],
+        "temperature": model.params["temperature"],
+        "max_documents": model.params["max_documents"],
+        "history_max_turns": model.params["history_max_turns"],
+        "history_max_tokens": model.params["history_max_tokens"],
+        "history_condense": model.params["history_condense"],
+        "context_packing_enabled": model.params["context_packing_enabled"],
+        "context_token_budget": model.params["context_token_budget"],
+        "context_dedupe_threshold": model.params["context_dedupe_threshold"],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _response_cache_key(model, row):
+    """Canonical hash of the question, chat history and generation parameters."""
+    payload = {
+        "question": row.question,
+        "context_key": row.context_key,
+        "retrieval_only": row.retrieval_only,
+        "embedding_model_name": model.params["embedding_model_name"],
+        # Answers and citations depend on the corpus the model was built with
+        "vectorstore": model.vectorstore_fingerprint,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _lookup_response_cache(model, rows):
+    """Answer rows whose exact inputs have been scored before."""
+    if model.response_cache is None:
+        return
+    for row in _answered(rows):
+        with _timed([row], "cache"):
+            cached = model.response_cache.get(row.key)
+        if cached is not None:
+            row.answer, row.context, row.scores = cached
+            row.cached = True
+
+
+def _update_response_cache(model, rows):
+    if model.response_cache is None:
+        return
+    for row in _answered(_pending(rows)):
+        model.response_cache.put(row.key, row.answer, row.context, row.scores)
+
+
+def _lookup_semantic_cache(model, rows):
+    """Answer rows from the semantic cache, embedding all questions in one call.
+
+    The question embeddings are kept on the rows so retrieval can reuse them for
+    rows without chat history.
+    """
+    rows = _answered(_pending(rows))
+    if model.semantic_cache is None or not rows:
+        return
+    with _timed(rows, "embedding"):
+        vectors = _embed(model.vectorstore, [row.question for row in rows])
+    for row, vector in zip(rows, vectors):
+        row.question_embedding = row.embedding = vector
+        with _timed([row], "cache"):
+            cached = model.semantic_cache.get(row.context_key, vector)
+        if cached is not None:
+            row.answer, row.context, row.scores = cached
+            row.cached = True
+
+
+def _update_semantic_cache(model, rows):
+    if model.semantic_cache is None:
+        return
+    for row in _answered(_pending(rows)):
+        model.semantic_cache.put(
+            row.context_key,
+            row.question_embedding,
+            (row.answer, row.context, row.scores),
+        )
+
+
+def _unique_rows(rows):
+    """First row of every group of rows with identical inputs, in input order."""
+    unique: dict[str, _Row] = {}
+    for row in rows:
+        unique.setdefault(row.key, row)
+    return list(unique.values())
+
+
+def _claim_in_flight(model, rows):
+    """Claim pending rows, leaving those already in flight elsewhere to wait on."""
+    if model.in_flight is None:
+        return
+    for row in _pending(rows):
+        row.in_flight, owner = model.in_flight.claim(row.key)
+        row.coalesced = not owner
+
+
+def _release_in_flight(model, rows):
+    """Publish the outcome of claimed rows to concurrent calls waiting on them."""
+    for row in rows:
+        if row.in_flight is not None and not row.coalesced:
+            model.in_flight.release(
+                row.key, row.in_flight, (row.answer, row.context, row.scores, row.error)
+            )
+
+
+def _await_in_flight(batch, rows):
+    """Take over the results of rows scored by concurrent calls."""
+    for row in rows:
+        if row.in_flight is None or not row.coalesced:
+            continue
+        with _timed([row], "coalesce"):
+            try:
+                row.answer, row.context, row.scores, row.error = row.in_flight.result(
+                    timeout=batch.remaining()
                 )
-            full_result_dict[target_feature_name].append(chain_output["answer"])
-            for i, doc in enumerate(chain_output["context"]):
-                if f"CITATION_CONTENT_{i}" not in full_result_dict:
-                    full_result_dict[f"CITATION_CONTENT_{i}"] = []
-                if f"CITATION_SOURCE_{i}" not in full_result_dict:
-                    full_result_dict[f"CITATION_SOURCE_{i}"] = []
-                if f"CITATION_PAGE_{i}" not in full_result_dict:
-                    full_result_dict[f"CITATION_PAGE_{i}"] = []
-                full_result_dict[f"CITATION_CONTENT_{i}"].append(doc.page_content)
-                full_result_dict[f"CITATION_SOURCE_{i}"].append(
-                    doc.metadata.get("source", "")
+            except FuturesTimeoutError:
+                row.error = _format_error(
+                    DeadlineExceeded(
+                        f"batch deadline of {batch.deadline_secs:g}s exceeded"
+                    )
                 )
-                full_result_dict[f"CITATION_PAGE_{i}"].append(
-                    doc.metadata.get("page", "")
+
+
+def _copy_duplicates(rows):
+    """Give duplicate rows the outcome of the first row with the same inputs."""
+    by_key = {row.key: row for row in _unique_rows(rows)}
+    for row in rows:
+        first = by_key[row.key]
+        if first is row:
+            continue
+        row.answer, row.context, row.error = first.answer, first.context, first.error
+        row.scores = first.scores
+        row.timings = dict(first.timings)
+        row.coalesced = True
+
+
+def window_chat_history(chat_history, count_tokens, max_turns=0, max_tokens=0):
+    """Split chat history into older messages and a window of recent turns.
+
+    A turn is a human message and the messages answering it. The window holds the
+    most recent whole turns, at most `max_turns` of them and `max_tokens` tokens in
+    total (either unlimited if 0). Returns `(older, recent)`.
+    """
+    turns: list[list] = []
+    for message in chat_history:
+        if message.type == "human" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    kept, tokens = 0, 0
+    for turn in reversed(turns):
+        tokens += sum(count_tokens(str(message.content)) for message in turn)
+        if (max_turns and kept >= max_turns) or (max_tokens and tokens > max_tokens):
+            break
+        kept += 1
+    split = sum(len(turn) for turn in turns[: len(turns) - kept])
+    return chat_history[:split], chat_history[split:]
+
+
+def _history_hashes(messages):
+    """Chained hashes of every prefix of `messages`, shortest first."""
+    hashes, digest = [], b""
+    for message in messages:
+        payload = json.dumps([message.type, message.content]).encode()
+        digest = hashlib.sha256(digest + payload).digest()
+        hashes.append(digest.hex())
+    return hashes
+
+
+def _condense_history(model, batch, row):
+    """Restrict the chat history to its recent window, summarizing older turns.
+
+    Summaries are cached by history hash. When a conversation outgrows its cached
+    summary, only the newly dropped turns are summarized together with it.
+    """
+    older, recent = window_chat_history(
+        row.chat_history,
+        model.count_tokens,
+        model.params["history_max_turns"],
+        model.params["history_max_tokens"],
+    )
+    row.chat_history = recent
+    if not older or model.condense_chain is None:
+        return
+    hashes = _history_hashes(older)
+    summary = model.history_summaries.get(hashes[-1])
+    if summary is None:
+        to_condense = older
+        for i in range(len(hashes) - 2, -1, -1):
+            previous = model.history_summaries.get(hashes[i])
+            if previous is not None:
+                to_condense = [
+                    SystemMessage(content=HISTORY_SUMMARY_PREFIX + previous)
+                ] + older[i + 1 :]
+                break
+        estimated_tokens = (
+            model.count_tokens(CONDENSE_HISTORY_SYSTEM_PROMPT)
+            + sum(model.count_tokens(str(m.content)) for m in to_condense)
+            + model.params["expected_completion_tokens"]
+        )
+        summary = _invoke_llm(
+            model,
+            batch,
+            row,
+            "condense",
+            estimated_tokens,
+            lambda: model.condense_chain.invoke({"chat_history": to_condense}),
+        )
+        model.history_summaries.put(hashes[-1], summary)
+    row.chat_history = [
+        SystemMessage(content=HISTORY_SUMMARY_PREFIX + summary)
+    ] + recent
+
+
+def _contextualize(model, batch, row):
+    """Rewrite the question into a standalone question using the chat history."""
+    if not row.chat_history:
+        row.standalone_question = row.question
+        return
+    estimated_tokens = _estimate_tokens(
+        model, row, CONTEXTUALIZE_Q_SYSTEM_PROMPT, row.question
+    )
+    inputs = {
+        "input": row.question,
+        "chat_history": row.chat_history,
+    }
+    row.standalone_question = _invoke_llm(
+        model,
+        batch,
+        row,
+        "contextualize",
+        estimated_tokens,
+        lambda: model.contextualize_chain.invoke(inputs),
+    )
+
+
+def _retrieve_batch(vectorstore, vectors, k):
+    """Retrieve the top `k` documents for every query vector with one search.
+
+    Returns the documents and their relevance scores (higher is more similar, as
+    in `FAISS.similarity_search_with_relevance_scores`) per query vector, in order.
+    """
+    vectors = np.array(vectors, dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(vectors)
+    distances, indices = vectorstore.index.search(vectors, k)
+    relevance_score_fn = vectorstore._select_relevance_score_fn()
+    documents, scores = [], []
+    for row_distances, row_indices in zip(distances, indices):
+        found = row_indices != -1
+        documents.append(
+            [
+                vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+                for i in row_indices[found]
+            ]
+        )
+        scores.append([relevance_score_fn(d) for d in row_distances[found]])
+    return documents, scores
+
+
+def _retrieve(model, batch, rows):
+    """Batch retrieval stage; a failure here fails every row still in flight.
+
+    Standalone questions that have not been embedded yet are embedded together in
+    one call before a single multi-query search.
+    """
+    pending = _pending(rows)
+    if not pending:
+        return
+    try:
+        batch.check_deadline()
+        to_embed = [
+            row
+            for row in pending
+            if row.embedding is None or row.standalone_question != row.question
+        ]
+        if to_embed:
+            with _timed(to_embed, "embedding"):
+                vectors = _embed(
+                    model.vectorstore, [row.standalone_question for row in to_embed]
                 )
+            for row, vector in zip(to_embed, vectors):
+                row.embedding = vector
+        with _timed(pending, "search"):
+            contexts, scores = _retrieve_batch(
+                model.vectorstore,
+                np.stack([row.embedding for row in pending]),
+                model.params["max_documents"],
+            )
+    except Exception as e:
+        for row in pending:
+            row.error = _format_error(e)
+        return
+    for row, context, row_scores in zip(pending, contexts, scores):
+        row.context = context
+        row.scores = row_scores
 
-        except Exception as e:
-            full_result_dict[target_feature_name].append(
-                f"{e.__class__.__name__}: {str(e)}"
+
+def _merge_overlap(first, second, anchor=64):
+    """Join two chunks if `second` starts inside `first`, e.g. overlapping splits.
+
+    Returns the merged text, or None if the chunks do not overlap.
+    """
+    position = first.find(second[:anchor])
+    while position != -1:
+        overlap = len(first) - position
+        if second[:overlap] == first[position:]:
+            return first + second[overlap:]
+        position = first.find(second[:anchor], position + 1)
+    return None
+
+
+def _similarity(first, second):
+    """Jaccard similarity of the word sets of two texts."""
+    first_words, second_words = set(first.split()), set(second.split())
+    if not first_words or not second_words:
+        return float(first_words == second_words)
+    return len(first_words & second_words) / len(first_words | second_words)
+
+
+def pack_context(documents, count_tokens, token_budget=0, dedupe_threshold=1.0):
+    """Reduce retrieved documents to the context actually worth sending to the LLM.
+
+    Documents are visited in relevance order. Overlapping chunks of the same source
+    are merged into the first one retrieved, near-duplicates (word set Jaccard
+    similarity of at least `dedupe_threshold`) are dropped, and the result is
+    filled greedily up to `token_budget` tokens (unlimited if 0).
+    """
+    packed: list[Document] = []
+    for doc in documents:
+        for i, kept in enumerate(packed):
+            if kept.metadata.get("source") == doc.metadata.get("source"):
+                merged = _merge_overlap(kept.page_content, doc.page_content)
+                merged = merged or _merge_overlap(doc.page_content, kept.page_content)
+                if merged is not None:
+                    packed[i] = Document(page_content=merged, metadata=kept.metadata)
+                    break
+            if _similarity(kept.page_content, doc.page_content) >= dedupe_threshold:
+                break
+        else:
+            packed.append(doc)
+
+    if token_budget <= 0:
+        return packed
+    budgeted, used = [], 0
+    for doc in packed:
+        tokens = count_tokens(doc.page_content)
+        if used + tokens <= token_budget:
+            budgeted.append(doc)
+            used += tokens
+    return budgeted
+
+
+def _pack_context(model, row):
+    scores = {id(doc): score for doc, score in zip(row.context, row.scores)}
+    row.context = pack_context(
+        row.context,
+        model.count_tokens,
+        model.params["context_token_budget"],
+        model.params["context_dedupe_threshold"],
+    )
+    # Merged chunks have no single score
+    row.scores = [scores.get(id(doc)) for doc in row.context]
+
+
+def _answer(model, batch, row):
+    """Answer the question from the retrieved context."""
+    estimated_tokens = _estimate_tokens(
+        model,
+        row,
+        model.params["stuff_prompt"],
+        row.question,
+        *[doc.page_content for doc in row.context],
+    )
+    inputs = {
+        "input": row.question,
+        "chat_history": row.chat_history,
+        "context": row.context,
+    }
+
+    def _call():
+        if model.hedger is not None:
+            return model.hedger.invoke(model.answer_chain, inputs, estimated_tokens)
+        return model.answer_chain.invoke(inputs)
+
+    row.answer = _invoke_llm(model, batch, row, "answer", estimated_tokens, _call)
+
+
+def _log_stage_metrics(rows, elapsed_secs):
+    """Print one line with p50/p95/max latency per stage and token totals."""
+    if not rows:
+        return
+    summary = [f"Scored {len(rows)} rows in {elapsed_secs:.2f}s"]
+    for stage in STAGES:
+        timings = [row.timings[stage] for row in rows if stage in row.timings]
+        if timings:
+            p50, p95 = np.percentile(timings, [50, 95])
+            summary.append(
+                f"{stage} p50={p50:.0f}ms p95={p95:.0f}ms max={max(timings):.0f}ms"
             )
+    summary.append(
+        f"tokens prompt={sum(row.prompt_tokens for row in rows)} "
+        f"completion={sum(row.completion_tokens for row in rows)}"
+    )
+    summary.append(
+        f"retries={sum(row.retries for row in rows)} "
+        f"coalesced={sum(row.coalesced for row in rows)} "
+        f"failed={sum(row.error is not None for row in rows)}"
+    )
+    print(" | ".join(summary))
+
+
+def _assemble_result(model, rows):
+    """Build the prediction columns from preallocated arrays, one per column.
+
+    Every row gets `max_documents` citations, padded with empty strings (and NaN
+    scores) when fewer documents were retrieved or the row failed. With
+    `arrow_output`, the result is backed by Arrow arrays instead of numpy objects.
+    """
+    n_rows, k = len(rows), model.params["max_documents"]
+    answers = np.empty(n_rows, dtype=object)
+    contents = np.full((k, n_rows), "", dtype=object)
+    sources = np.full((k, n_rows), "", dtype=object)
+    pages = np.full((k, n_rows), "", dtype=object)
+    scores = np.full((k, n_rows), np.nan)
+    for j, row in enumerate(rows):
+        if row.error is not None:
+            answers[j] = row.error
+            continue
+        answers[j] = row.answer
+        for i, doc in enumerate(row.context[:k]):
+            contents[i, j] = doc.page_content
+            sources[i, j] = doc.metadata.get("source", "")
+            pages[i, j] = str(doc.metadata.get("page", ""))
+        for i, doc_score in enumerate(row.scores[:k]):
+            if doc_score is not None:
+                scores[i, j] = doc_score
+
+    columns: dict[str, np.ndarray] = {model.params["target_feature_name"]: answers}
+    for i in range(k):
+        columns[f"CITATION_CONTENT_{i}"] = contents[i]
+        columns[f"CITATION_SOURCE_{i}"] = sources[i]
+        columns[f"CITATION_PAGE_{i}"] = pages[i]
+        columns[f"CITATION_SCORE_{i}"] = scores[i]
+    if model.params["return_stage_metrics"]:
+        for stage in STAGES:
+            columns[f"LATENCY_{stage.upper()}_MS"] = np.fromiter(
+                (row.timings.get(stage, 0.0) for row in rows), np.float64, n_rows
+            )
+        columns["PROMPT_TOKENS"] = np.fromiter(
+            (row.prompt_tokens for row in rows), np.int64, n_rows
+        )
+        columns["COMPLETION_TOKENS"] = np.fromiter(
+            (row.completion_tokens for row in rows), np.int64, n_rows
+        )
+
+    if model.params["arrow_output"]:
+        import pyarrow as pa  # type: ignore
+        from pandas import ArrowDtype  # type: ignore
+
+        return pa.table(columns).to_pandas(types_mapper=ArrowDtype)
+    return DataFrame(columns, copy=False)
+
+
+def score(data, model, **kwargs):
+    """ "Orchestrate a RAG completion with our vector database.
+
+    Rows are scored in three stages: question contextualization and answering run
+    concurrently with at most `max_concurrency` LLM calls in flight, while retrieval
+    embeds and searches the whole batch at once. With context packing enabled, the
+    retrieved documents are merged, deduplicated and trimmed to a token budget
+    before answering. When enabled, rows whose exact inputs were scored before
+    (response cache) or similar enough to a previously answered question (semantic
+    cache) skip all three stages. Results are returned in input order.
+
+    Chat history is limited to a window of recent turns, optionally summarizing
+    older turns first, before it is sent to the LLM.
+
+    Rows flagged `retrieval_only`, by the runtime parameter or a `retrieval_only`
+    column, skip the LLM entirely and return an empty answer with citations and
+    their relevance scores (`CITATION_SCORE_<i>`).
+
+    With `coalesce_duplicates`, rows with identical question and chat history are
+    scored once per batch, and rows already being scored by a concurrent call wait
+    for that call's result instead of calling the LLM again.
+
+    Transient LLM errors are retried within a per-batch retry budget, and rows not
+    finished by the batch deadline are returned as `DeadlineExceeded` failures.
+
+    Per-stage latencies and token usage are logged for every batch and, with
+    `return_stage_metrics`, returned as `LATENCY_<STAGE>_MS`, `PROMPT_TOKENS` and
+    `COMPLETION_TOKENS` columns.
+    """
+    prompt_feature_name = model.params["prompt_feature_name"]
+
+    start = time.perf_counter()
+    rows = [
+        _Row(
+            question=row[prompt_feature_name],
+            chat_history=_parse_chat_history(row),
+            retrieval_only=_parse_retrieval_only(row, model.params["retrieval_only"]),
+        )
+        for _, row in data.iterrows()
+    ]
+    for row in rows:
+        row.context_key = _context_key(model, row)
+        row.key = _response_cache_key(model, row)
+    unique = _unique_rows(rows) if model.params["coalesce_duplicates"] else rows
+    batch = _Batch(len(unique), model.params)
+    _lookup_response_cache(model, unique)
+    _lookup_semantic_cache(model, unique)
+    _claim_in_flight(model, unique)
+    answered = _answered(unique)
+    for row in unique:
+        if row.retrieval_only:
+            # Searched with the question as asked, ignoring the chat history
+            row.standalone_question = row.question
+    ex = ThreadPoolExecutor(max_workers=max(1, model.params["max_concurrency"]))
+    try:
+        if model.params["history_max_turns"] or model.params["history_max_tokens"]:
+            _run_stage(
+                ex, batch, answered, lambda row: _condense_history(model, batch, row)
+            )
+        _run_stage(ex, batch, answered, lambda row: _contextualize(model, batch, row))
+        _retrieve(model, batch, unique)
+        if model.params["context_packing_enabled"]:
+            _run_stage(ex, batch, answered, lambda row: _pack_context(model, row))
+        _run_stage(ex, batch, answered, lambda row: _answer(model, batch, row))
+    finally:
+        # Calls still running past the deadline are abandoned, not awaited
+        ex.shutdown(wait=False, cancel_futures=True)
+        _release_in_flight(model, unique)
+    _await_in_flight(batch, unique)
+    _update_response_cache(model, unique)
+    _update_semantic_cache(model, unique)
+    if model.params["coalesce_duplicates"]:
+        _copy_duplicates(rows)
+    for name, cache in [
+        ("Response", model.response_cache),
+        ("Semantic", model.semantic_cache),
+    ]:
+        if cache is not None:
+            print(f"{name} cache: {cache.hits} hits, {cache.misses} misses since load")
+    if model.in_flight is not None:
+        print(
+            f"Coalesced {model.in_flight.coalesced} rows with concurrent requests "
+            "since load"
+        )
+    if model.hedger is not None:
+        print(
+            f"Hedged requests: {model.hedger.fired} fired, {model.hedger.won} won, "
+            f"{model.hedger.skipped} skipped for rate limits since load "
+            f"(current delay {model.hedger.delay():.2f}s)"
+        )
+    _log_stage_metrics(rows, time.perf_counter() - start)
 
-    return DataFrame(full_result_dict)
+    return _assemble_result(model, rows)
 
 
 if __name__ == "__main__":
-    client, prompt_feature_name, target_feature_name = load_model(".")
+    model = load_model(".")
+    prompt_feature_name = model.params["prompt_feature_name"]
     data = DataFrame(
         {
             prompt_feature_name: [
@@ -216,5 +1880,5 @@ if __name__ == "__main__":
             ],
         }
     )
-    result = score(data, (client, prompt_feature_name, target_feature_name))
+    result = score(data, model)
     print(result)
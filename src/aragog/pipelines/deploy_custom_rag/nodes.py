@@ -7,20 +7,253 @@
 
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Any
+import logging
+from typing import TYPE_CHECKING, Any, cast
 
 if TYPE_CHECKING:
     import pathlib
     import tempfile
+    from collections.abc import Callable, Iterable, Iterator
+    from concurrent.futures import Executor
+
+    import faiss
+    import numpy as np
+    import numpy.typing as npt
+    import pandas as pd
+    from langchain.schema import Document
+    from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger(__name__)
+
+
+def _format_source(source: str, root: str) -> str:
+    """
+    this function helps formatting the metadata to create a URL
+    edit to your needs
+    """
+    import re
+
+    https_string = re.compile(r".+(https://.+)$")
+
+    source = source.replace("|", "/").replace(root, "")
+    source = re.sub(
+        r"datarobot_docs/en/(.+)\.txt",
+        r"https://docs.datarobot.com/en/docs/\1.html",
+        source,
+    )
+    try:
+        source = https_string.findall(source)[0]
+    except Exception:
+        pass
+    return source
+
+
+def _list_source_files(path_to_source_documents: pathlib.Path) -> list[pathlib.Path]:
+    """Source files to ingest, in a deterministic order.
+
+    Matches what DirectoryLoader would load: files matching the source filter,
+    excluding hidden files and directories.
+    """
+    SOURCE_DOCUMENTS_FILTER = "**/*.*"  # "**/*.pdf" or "**/*.txt"
+
+    root = path_to_source_documents.resolve()
+    return sorted(
+        path
+        for path in root.glob(SOURCE_DOCUMENTS_FILTER)
+        if path.is_file()
+        and not any(part.startswith(".") for part in path.relative_to(root).parts)
+    )
+
+
+def _chunk_file(
+    file_path: pathlib.Path, root: str, chunk_size: int, chunk_overlap: int
+) -> list[dict[str, Any]]:
+    """Load, split and format the metadata of a single source file.
+
+    Runs in ingestion worker processes, so it returns plain chunk records.
+    """
+    from langchain.text_splitter import MarkdownTextSplitter
+    from langchain_community.document_loaders import UnstructuredFileLoader
+
+    splitter = MarkdownTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    docs = splitter.split_documents(UnstructuredFileLoader(str(file_path)).load())
+    for doc in docs:
+        doc.metadata["source"] = _format_source(doc.metadata["source"], root)
+    return [
+        {"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs
+    ]
+
+
+def _chunk_files(
+    files: list[pathlib.Path],
+    chunk_file: Callable[[pathlib.Path], list[dict[str, Any]]],
+    executor: Executor | None,
+    workers: int,
+) -> list[list[dict[str, Any]]]:
+    """Chunk files in `executor`'s `workers` processes, returning chunks per file.
+
+    Without an executor, or for a single file, chunks in this process instead.
+    """
+    if executor is None or len(files) <= 1:
+        return [chunk_file(path) for path in files]
+    # map preserves input order, so the output does not depend on workers
+    return list(
+        executor.map(chunk_file, files, chunksize=max(1, len(files) // (4 * workers)))
+    )
+
+
+def _chunks_frame(records: list[dict[str, Any]]) -> pd.DataFrame:
+    """One partition of chunks, with metadata as json so any file format fits it."""
+    import json
+
+    import pandas as pd
+
+    return pd.DataFrame(
+        {
+            "page_content": [record["page_content"] for record in records],
+            "metadata": [json.dumps(record["metadata"]) for record in records],
+        }
+    )
+
+
+def _chunk_partition(
+    files: list[pathlib.Path],
+    chunk_file: Callable[[pathlib.Path], list[dict[str, Any]]],
+    executor: Executor | None,
+    workers: int,
+    last: bool = False,
+) -> pd.DataFrame:
+    """Chunk one partition of files, shutting the executor down after the `last`."""
+    import time
+
+    start = time.perf_counter()
+    try:
+        records = [
+            record
+            for file_records in _chunk_files(files, chunk_file, executor, workers)
+            for record in file_records
+        ]
+    finally:
+        if last and executor is not None:
+            executor.shutdown()
+    logger.info(
+        "Chunked %d files into %d chunks with %d workers in %.1fs",
+        len(files),
+        len(records),
+        workers,
+        time.perf_counter() - start,
+    )
+    return _chunks_frame(records)
+
+
+def _load_chunk_cache(cache_paths: list[pathlib.Path]) -> pd.DataFrame:
+    import json
+
+    return _chunks_frame(
+        [record for path in cache_paths for record in json.loads(path.read_text())]
+    )
+
+
+def _file_sha256(path: pathlib.Path) -> str:
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _chunk_incrementally(
+    files: list[pathlib.Path],
+    root: pathlib.Path,
+    chunk_file: Callable[[pathlib.Path], list[dict[str, Any]]],
+    executor: Executor | None,
+    workers: int,
+    state_dir: pathlib.Path,
+    settings: dict[str, Any],
+    files_per_batch: int,
+) -> list[pathlib.Path]:
+    """Re-chunk only source files added or changed since the previous run.
+
+    `manifest.json` in `state_dir` records the content hash and chunk IDs of every
+    source file, and the chunks of each file are kept under `chunks/`. Chunks get
+    stable integer IDs (`metadata["chunk_id"]`) so the vector db can be updated in
+    place. Changing the chunking settings re-chunks everything. Returns the chunk
+    file of every source file, in order.
+    """
+    import hashlib
+    import json
+
+    manifest_path = state_dir / "manifest.json"
+    chunks_dir = state_dir / "chunks"
+    chunks_dir.mkdir(parents=True, exist_ok=True)
+    manifest: dict[str, Any] = {"settings": settings, "next_id": 0, "files": {}}
+    if manifest_path.exists():
+        previous = json.loads(manifest_path.read_text())
+        manifest["next_id"] = previous["next_id"]
+        if previous["settings"] == settings:
+            manifest["files"] = previous["files"]
+        else:
+            logger.info("Chunking settings changed, re-chunking all source files")
+
+    def _cache_path(name: str) -> pathlib.Path:
+        return chunks_dir / f"{hashlib.sha256(name.encode()).hexdigest()}.json"
+
+    names = [str(path.relative_to(root)) for path in files]
+    hashes = {name: _file_sha256(path) for name, path in zip(names, files)}
+    deleted = set(manifest["files"]) - set(hashes)
+    for name in deleted:
+        _cache_path(name).unlink(missing_ok=True)
+        del manifest["files"][name]
+    changed = [
+        (name, path)
+        for name, path in zip(names, files)
+        if manifest["files"].get(name, {}).get("sha256") != hashes[name]
+    ]
+    for i in range(0, len(changed), files_per_batch):
+        batch = changed[i : i + files_per_batch]
+        chunked = _chunk_files(
+            [path for _, path in batch], chunk_file, executor, workers
+        )
+        for (name, _), records in zip(batch, chunked):
+            chunk_ids = list(
+                range(manifest["next_id"], manifest["next_id"] + len(records))
+            )
+            manifest["next_id"] += len(records)
+            for record, chunk_id in zip(records, chunk_ids):
+                record["metadata"]["chunk_id"] = chunk_id
+            _cache_path(name).write_text(json.dumps(records))
+            manifest["files"][name] = {"sha256": hashes[name], "chunk_ids": chunk_ids}
+
+    manifest_path.write_text(json.dumps(manifest))
+    logger.info(
+        "Incremental chunking: %d files added or changed, %d deleted, %d unchanged",
+        len(changed),
+        len(deleted),
+        len(files) - len(changed),
+    )
+    return [_cache_path(name) for name in names]
 
 
 def make_chunks(
-    path_to_source_documents: pathlib.Path, chunk_size: int, chunk_overlap: int
-) -> dict[str, Any]:
+    path_to_source_documents: pathlib.Path,
+    chunk_size: int,
+    chunk_overlap: int,
+    workers: int = 1,
+    incremental: dict[str, Any] | None = None,
+    files_per_partition: int = 500,
+) -> dict[str, Callable[[], pd.DataFrame]]:
     """Convert raw documents into document chunks that can be ingested into a vector db.
 
     This node will often need to be tailored to your source documents.
 
+    Chunks are produced lazily, one partition of source files at a time, as the
+    partitioned dataset saves them, so memory does not grow with the corpus.
+
     Parameters
     ----------
     path_to_source_documents : pathlib.Path
@@ -29,79 +262,733 @@ def make_chunks(
         Document splitting chunk size
     chunk_overlap : int
         Document splitting overlap size
+    workers : int, optional
+        Number of processes source files are loaded and split in, 0 for one per
+        CPU. Chunks are returned in source file order regardless.
+    incremental : dict, optional
+        With `enabled`, only files added or changed since the previous run are
+        chunked, tracked by content hash in `state_dir`, and every chunk carries a
+        stable `chunk_id` in its metadata.
+    files_per_partition : int, optional
+        Number of source files chunked into each output partition
 
     Returns
     -------
-    str :
-        Document chunks as a list of langchain.schema.document.Document objects serialized to
-        json. Each document should have its metadata['source'] attribute populated to allow
-        the front end to report citations back to the user.
+    dict :
+        Partition name to a function returning the partition's document chunks as a
+        DataFrame with `page_content` and json-serialized `metadata` columns, in
+        source file order. Each document should have its metadata['source']
+        attribute populated to allow the front end to report citations back to the
+        user.
     """
-    import re
+    import functools
+    import os
+    import pathlib
+    from concurrent.futures import ProcessPoolExecutor
 
     import nltk
-    from langchain.text_splitter import MarkdownTextSplitter
-    from langchain_community.document_loaders import DirectoryLoader
-
-    def _format_metadata():
-        """
-        this function helps formatting the metadata to create a URL
-        edit to your needs
-        """
-        https_string = re.compile(r".+(https://.+)$")
-
-        for doc in docs:
-            doc.metadata["source"] = (
-                doc.metadata["source"]
-                .replace("|", "/")
-                .replace(str(path_to_source_documents.resolve()), "")
+
+    nltk.download("punkt", quiet=True)
+    nltk.download("punkt_tab", quiet=True)
+    nltk.download("averaged_perceptron_tagger_eng", quiet=True)
+
+    files = _list_source_files(path_to_source_documents)
+    chunk_file = functools.partial(
+        _chunk_file,
+        root=str(path_to_source_documents.resolve()),
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    workers = workers or os.cpu_count() or 1
+    # One pool for all partitions and batches, so worker processes start only once
+    executor = (
+        ProcessPoolExecutor(max_workers=workers)
+        if workers > 1 and len(files) > 1
+        else None
+    )
+    if incremental and incremental.get("enabled"):
+        try:
+            cache_paths = _chunk_incrementally(
+                files,
+                path_to_source_documents.resolve(),
+                chunk_file,
+                executor,
+                workers,
+                pathlib.Path(incremental["state_dir"]),
+                {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap},
+                files_per_partition,
+            )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    partitions: dict[str, Callable[[], pd.DataFrame]] = {}
+    for n, i in enumerate(range(0, len(files), files_per_partition)):
+        if incremental and incremental.get("enabled"):
+            load_partition = functools.partial(
+                _load_chunk_cache, cache_paths[i : i + files_per_partition]
             )
+        else:
+            # Partitions are chunked lazily, in order, as the dataset saves them
+            load_partition = functools.partial(
+                _chunk_partition,
+                files[i : i + files_per_partition],
+                chunk_file,
+                executor,
+                workers,
+                last=i + files_per_partition >= len(files),
+            )
+        partitions[f"chunks_{n:05d}"] = load_partition
+    logger.info(
+        "Chunking %d source files into %d partitions", len(files), len(partitions)
+    )
+    return partitions
+
+
+def _make_faiss_index(
+    vectors: npt.NDArray[np.float32],
+    index_params: dict[str, Any],
+    ids: npt.NDArray[np.int64] | None = None,
+) -> faiss.Index:
+    """Build and populate a FAISS index of the configured type.
+
+    Supported types are `flat` (exact search), `hnsw`, `ivf_flat`, `ivf_pq`, `sq8`
+    and `sq_fp16` (8 bit / float16 scalar quantization). All indexes use L2
+    distance, like the flat index langchain builds by default. With `ids`, search
+    returns those IDs instead of vector positions and vectors can be removed by ID.
+    """
+    import faiss
+    import numpy as np
 
-            doc.metadata["source"] = re.sub(
-                r"datarobot_docs/en/(.+)\.txt",
-                r"https://docs.datarobot.com/en/docs/\1.html",
-                doc.metadata["source"],
+    dim = vectors.shape[1]
+    index_type = index_params.get("type", "flat")
+    # IVF needs at least as many training vectors as inverted lists
+    nlist = min(index_params.get("ivf_nlist", 256), len(vectors))
+    index: faiss.Index
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dim, index_params.get("hnsw_m", 32))
+        hnsw.hnsw.efConstruction = index_params.get("hnsw_ef_construction", 200)
+        index = hnsw
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist)
+    elif index_type == "ivf_pq":
+        # Training each sub-quantizer needs at least 2**pq_nbits vectors
+        pq_nbits = index_params.get("pq_nbits", 8)
+        if len(vectors) < 2**pq_nbits:
+            pq_nbits = max(1, int(np.log2(len(vectors))))
+            logger.warning(
+                "Reducing pq_nbits from %d to %d to train on %d vectors",
+                index_params.get("pq_nbits", 8),
+                pq_nbits,
+                len(vectors),
             )
-            try:
-                doc.metadata["source"] = https_string.findall(doc.metadata["source"])[0]
-            except Exception:
-                pass
+        index = faiss.IndexIVFPQ(
+            faiss.IndexFlatL2(dim),
+            dim,
+            nlist,
+            index_params.get("pq_m", 16),
+            pq_nbits,
+        )
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+    elif index_type == "sq_fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16)
+    else:
+        raise ValueError(f"Unsupported FAISS index type: {index_type}")
 
-    SOURCE_DOCUMENTS_FILTER = "**/*.*"  # "**/*.pdf" or "**/*.txt"
+    if not index.is_trained:
+        index.train(vectors)
+    if ids is None:
+        index.add(vectors)
+    else:
+        if index_type not in ("ivf_flat", "ivf_pq"):
+            # IVF indexes store IDs natively, the others need an ID mapping
+            index = faiss.IndexIDMap2(index)
+        index.add_with_ids(vectors, ids)
+    _set_faiss_search_params(index, index_params)
+    return index
+
+
+def _set_faiss_search_params(index: faiss.Index, index_params: dict[str, Any]) -> None:
+    """Apply the search-time settings, `ivf_nprobe` and `hnsw_ef_search`.
+
+    Both are persisted with the index, so they also apply when serving, and can
+    change without rebuilding it.
+    """
+    import faiss
+
+    index_type = index_params.get("type", "flat")
+    if index_type in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = index_params.get("ivf_nprobe", 16)
+    elif index_type == "hnsw":
+        if isinstance(index, faiss.IndexIDMap):
+            index = faiss.downcast_index(index.index)
+        hnsw = cast(faiss.IndexHNSW, index).hnsw
+        hnsw.efSearch = index_params.get("hnsw_ef_search", 64)
+
+
+def _index_build_settings(index_params: dict[str, Any]) -> dict[str, Any]:
+    """The index settings that change how an index is built, as opposed to searched."""
+    return {
+        key: index_params.get(key)
+        for key in (
+            "type",
+            "ivf_nlist",
+            "pq_m",
+            "pq_nbits",
+            "hnsw_m",
+            "hnsw_ef_construction",
+        )
+    }
+
+
+def _report_faiss_index(
+    index: faiss.Index,
+    vectors: npt.NDArray[np.float32],
+    build_secs: float,
+    index_params: dict[str, Any],
+    ids: npt.NDArray[np.int64] | None = None,
+) -> dict[str, Any] | None:
+    """Compare an index against exact search over a sample of the indexed vectors.
+
+    Only runs when `report` is set in `index_params` and the index is not already
+    exact. `ids` are the IDs the vectors were indexed with, if any.
+    """
+    import os
+    import tempfile
+    import time
+
+    import faiss
+    import numpy as np
+
+    if not index_params.get("report") or index_params.get("type", "flat") == "flat":
+        return None
+    k = min(index_params.get("report_k", 10), len(vectors))
+    rng = np.random.default_rng(0)
+    n_queries = min(index_params.get("report_queries", 200), len(vectors))
+    queries = vectors[rng.choice(len(vectors), n_queries, replace=False)]
+
+    # Brute-force search over the vectors themselves, without copying them into
+    # a second index
+    _, expected = faiss.knn(queries, vectors, k)
+    if ids is not None:
+        expected = ids[expected]
+
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query[None, :], k)
+    query_ms = (time.perf_counter() - start) * 1000 / n_queries
+    _, retrieved = index.search(queries, k)
 
-    loader = DirectoryLoader(
-        str(path_to_source_documents.resolve()), glob=SOURCE_DOCUMENTS_FILTER
+    recall = np.mean(
+        [len(set(r) & set(e)) / k for r, e in zip(retrieved, expected, strict=True)]
     )
-    splitter = MarkdownTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
+    with tempfile.NamedTemporaryFile(suffix=".faiss") as f:
+        faiss.write_index(index, f.name)
+        index_size = os.path.getsize(f.name)
+    report = {
+        "index_type": index_params.get("type", "flat"),
+        "n_vectors": len(vectors),
+        "index_size_mb": index_size / 2**20,
+        "flat_size_mb": vectors.nbytes / 2**20,
+        "build_secs": build_secs,
+        "query_latency_ms": query_ms,
+        f"recall@{k}": float(recall),
+    }
+    logger.info("FAISS index report: %s", report)
+    return report
+
+
+def _save_vectorstore(
+    folder_path: str,
+    index: faiss.Index,
+    documents: Iterable[Document],
+    ids: npt.NDArray[np.int64] | None = None,
+) -> None:
+    """Persist a FAISS index and a columnar docstore for the custom RAG model.
+
+    Documents are written as packed json records to `docstore.bin`, with their byte
+    offsets in `docstore_offsets.npy`, in the same order as the index vectors. The
+    model memory-maps both files and only decodes the documents it retrieves. For
+    an index searched by ID, the ID of every document is saved in
+    `docstore_ids.npy`.
+    """
+    import json
+    import os
+
+    import faiss
+    import numpy as np
+
+    os.makedirs(folder_path, exist_ok=True)
+    faiss.write_index(index, os.path.join(folder_path, "index.faiss"))
+    offsets = [0]
+    with open(os.path.join(folder_path, "docstore.bin"), "wb") as f:
+        for doc in documents:
+            record = json.dumps(
+                {"page_content": doc.page_content, "metadata": doc.metadata}
+            ).encode("utf-8")
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.save(
+        os.path.join(folder_path, "docstore_offsets.npy"),
+        np.asarray(offsets, dtype=np.int64),
     )
+    if ids is not None:
+        np.save(os.path.join(folder_path, "docstore_ids.npy"), ids)
 
-    nltk.download("punkt", quiet=True)
-    nltk.download("punkt_tab", quiet=True)
-    nltk.download("averaged_perceptron_tagger_eng", quiet=True)
 
-    data = loader.load()
-    docs = splitter.split_documents(data)
+def _read_embedding_shards(
+    folder_path: str,
+) -> list[tuple[npt.NDArray[np.bytes_], npt.NDArray[np.float32]]]:
+    """Text hashes and memory-mapped vectors of every embedding cache shard."""
+    import os
+
+    import numpy as np
+
+    if not os.path.isdir(folder_path):
+        return []
+    return [
+        (
+            np.load(os.path.join(folder_path, name, "keys.npy")),
+            np.load(os.path.join(folder_path, name, "vectors.npy"), mmap_mode="r"),
+        )
+        for name in sorted(os.listdir(folder_path))
+        if name.startswith("shard-")
+    ]
+
+
+def _write_embedding_shard(
+    folder_path: str, keys: list[bytes], vectors: npt.NDArray[np.float32]
+) -> None:
+    """Add a shard to the embedding cache with a single atomic rename."""
+    import os
+    import tempfile
+    import time
+    import uuid
+
+    import numpy as np
+
+    os.makedirs(folder_path, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=folder_path)
+    np.save(os.path.join(tmp_path, "keys.npy"), np.asarray(keys, dtype="S32"))
+    np.save(os.path.join(tmp_path, "vectors.npy"), vectors)
+    os.rename(
+        tmp_path,
+        os.path.join(folder_path, f"shard-{time.time_ns()}-{uuid.uuid4().hex[:8]}"),
+    )
+
+
+class _EmbeddingCache:
+    """Chunk embeddings computed in earlier runs, for one embedding model.
+
+    Vectors are addressed by the sha256 of the whitespace- and unicode-normalized
+    text and stored per `model_key` (embedding model name and revision) in shards,
+    directories holding the text hashes in `keys.npy` and their vectors in
+    `vectors.npy`, memory-mapped on load. The shard index is read once when the
+    cache is opened. Vectors embedded afterwards are kept in memory and written
+    as one new shard by `flush`, so a build reads and writes the cache once
+    however many partitions it embeds. Shards are never modified: each is written
+    to a temporary directory and renamed into place, so concurrent builds neither
+    see partial writes nor overwrite each other's vectors.
+    """
+
+    def __init__(self, cache_dir: str, model_key: str):
+        import hashlib
+        import os
+
+        self.folder_path = os.path.join(
+            cache_dir, hashlib.sha256(model_key.encode()).hexdigest()[:16]
+        )
+        self._shards = _read_embedding_shards(self.folder_path)
+        self._positions: dict[bytes, tuple[int, int]] = {}
+        for shard, (shard_keys, _) in enumerate(self._shards):
+            for row, key in enumerate(shard_keys.tolist()):
+                self._positions.setdefault(key, (shard, row))
+        self._new_keys: list[bytes] = []
+        self._new_vectors: list[npt.NDArray[np.float32]] = []
+
+    def embed(
+        self, texts: list[str], embed: Callable[[list[str]], npt.NDArray[np.float32]]
+    ) -> npt.NDArray[np.float32]:
+        """Embed texts, only calling `embed` for texts missing from the cache."""
+        import hashlib
+        import unicodedata
+
+        import numpy as np
+
+        if not texts:
+            return embed(texts)
+        keys = [
+            hashlib.sha256(
+                " ".join(unicodedata.normalize("NFC", text).split()).encode("utf-8")
+            ).digest()
+            for text in texts
+        ]
+        missing: dict[bytes, int] = {}
+        for i, key in enumerate(keys):
+            if key not in self._positions and key not in missing:
+                missing[key] = i
+        hits = sum(key in self._positions for key in keys)
+        logger.info(
+            "Embedding cache: %d of %d chunks cached (%.0f%% hit rate), embedding %d",
+            hits,
+            len(keys),
+            100 * hits / max(1, len(keys)),
+            len(missing),
+        )
+        if missing:
+            new_vectors = embed([texts[i] for i in missing.values()])
+            for row, key in enumerate(missing):
+                self._positions[key] = (len(self._shards), row)
+            self._shards.append((np.asarray(list(missing), dtype="S32"), new_vectors))
+            self._new_keys.extend(missing)
+            self._new_vectors.append(new_vectors)
+        return np.stack(
+            [
+                self._shards[shard][1][row]
+                for shard, row in (self._positions[key] for key in keys)
+            ]
+        )
+
+    def flush(self) -> None:
+        """Write the vectors embedded since the cache was opened as one shard."""
+        import numpy as np
+
+        if self._new_keys:
+            _write_embedding_shard(
+                self.folder_path, self._new_keys, np.concatenate(self._new_vectors)
+            )
+            self._new_keys, self._new_vectors = [], []
+
+
+def _model_revision(model: SentenceTransformer) -> str:
+    """Hugging Face Hub commit the model's weights were loaded from, if known."""
+    auto_model = getattr(model[0], "auto_model", None)
+    return str(getattr(getattr(auto_model, "config", None), "_commit_hash", "") or "")
+
+
+def _start_encode_pool(model: SentenceTransformer, processes: int) -> dict[str, Any]:
+    """Start `processes` CPU encode workers, splitting the cores between them."""
+    import os
+
+    previous = os.environ.get("OMP_NUM_THREADS")
+    # Read by torch in the spawned workers, so they do not oversubscribe the cores
+    os.environ["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // processes))
+    try:
+        return cast(
+            "dict[str, Any]",
+            model.start_multi_process_pool(target_devices=["cpu"] * processes),
+        )
+    finally:
+        if previous is None:
+            del os.environ["OMP_NUM_THREADS"]
+        else:
+            os.environ["OMP_NUM_THREADS"] = previous
+
+
+def _encode_by_length(
+    model: SentenceTransformer,
+    texts: list[str],
+    batch_size: int,
+    pool: dict[str, Any] | None = None,
+) -> npt.NDArray[np.float32]:
+    """Embed texts in batches of similar length to minimize padding.
+
+    Texts are sorted by length across the whole call, so the chunks handed to the
+    workers of a multi-process pool are of similar length too. Newlines are
+    replaced like HuggingFaceEmbeddings does, so vectors match the custom model's
+    query embeddings.
+    """
+    import numpy as np
+
+    texts = [text.replace("\n", " ") for text in texts]
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), np.float32)
+    order = np.argsort([-len(text) for text in texts], kind="stable")
+    sorted_texts = [texts[i] for i in order]
+    if pool is None:
+        vectors = model.encode(sorted_texts, batch_size=batch_size)
+    else:
+        vectors = model.encode_multi_process(sorted_texts, pool, batch_size=batch_size)
+    result = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+    result[order] = vectors
+    return result
+
+
+def _iter_document_batches(
+    docs: dict[str, Callable[[], pd.DataFrame]],
+) -> Iterator[list[Document]]:
+    """Documents of every `make_chunks` partition, one partition at a time, in order."""
+    import json
+
+    from langchain.schema import Document
+
+    for partition_id in sorted(docs):
+        frame = docs[partition_id]()
+        yield [
+            Document(page_content=page_content, metadata=json.loads(metadata))
+            for page_content, metadata in zip(frame["page_content"], frame["metadata"])
+        ]
+
+
+def _update_faiss_index(
+    state_dir: pathlib.Path,
+    batches: Iterable[list[Document]],
+    embed: Callable[[list[str]], npt.NDArray[np.float32]],
+    index_params: dict[str, Any],
+    settings: dict[str, Any],
+) -> tuple[faiss.Index, npt.NDArray[np.int64]]:
+    """Bring the index kept in `state_dir` in line with the documents, in place.
+
+    Vectors of chunks no longer present are removed and only new chunks are
+    embedded and added, by their `chunk_id`. Quantizers trained by the previous
+    build are reused. The index is rebuilt from scratch on the first run, when
+    `settings` (the embedding model and the index build settings) change and for
+    HNSW indexes, which do not support removal. Search settings are applied to the
+    reused index. Returns the index and the chunk IDs of all documents.
+    """
+    import json
+    import time
+
+    import faiss
+    import numpy as np
+
+    index_path = state_dir / "index.faiss"
+    ids_path = state_dir / "index_ids.npy"
+    settings_path = state_dir / "index_settings.json"
+    reusable = (
+        index_path.exists()
+        and settings_path.exists()
+        and json.loads(settings_path.read_text()) == settings
+        and index_params.get("type", "flat") != "hnsw"
+    )
+
+    def _chunk_ids(batch: list[Document]) -> npt.NDArray[np.int64]:
+        return np.asarray([doc.metadata["chunk_id"] for doc in batch], dtype=np.int64)
+
+    if reusable:
+        start = time.perf_counter()
+        index = faiss.read_index(str(index_path))
+        _set_faiss_search_params(index, index_params)
+        indexed = np.load(ids_path)
+        batch_ids, n_added = [], 0
+        for batch in batches:
+            batch_ids.append(_chunk_ids(batch))
+            added = np.flatnonzero(~np.isin(batch_ids[-1], indexed))
+            if len(added):
+                vectors = embed([batch[i].page_content for i in added])
+                index.add_with_ids(vectors, batch_ids[-1][added])
+                n_added += len(added)
+        ids = np.concatenate(batch_ids)
+        removed = np.setdiff1d(indexed, ids)
+        if len(removed):
+            index.remove_ids(
+                faiss.IDSelectorBatch(len(removed), faiss.swig_ptr(removed))
+            )
+        logger.info(
+            "Updated FAISS index in place in %.1fs: %d chunks added, %d removed, "
+            "%d unchanged",
+            time.perf_counter() - start,
+            n_added,
+            len(removed),
+            len(ids) - n_added,
+        )
+    else:
+        batch_ids, batch_vectors = [], []
+        for batch in batches:
+            batch_ids.append(_chunk_ids(batch))
+            batch_vectors.append(embed([doc.page_content for doc in batch]))
+        ids, vectors = np.concatenate(batch_ids), np.concatenate(batch_vectors)
+        start = time.perf_counter()
+        index = _make_faiss_index(vectors, index_params, ids)
+        _report_faiss_index(
+            index, vectors, time.perf_counter() - start, index_params, ids
+        )
+
+    state_dir.mkdir(parents=True, exist_ok=True)
+    faiss.write_index(index, str(index_path))
+    np.save(ids_path, ids)
+    settings_path.write_text(json.dumps(settings))
+    return index, ids
 
-    _format_metadata()
 
-    return {"docs": [doc.to_json() for doc in docs]}
+def _onnx_encode(folder_path: str, texts: list[str]) -> npt.NDArray[np.float32]:
+    """Embed texts with an exported ONNX model the same way the custom model does."""
+    import json
+    import os
+
+    import numpy as np
+    import onnxruntime
+    from tokenizers import Tokenizer
+
+    with open(os.path.join(folder_path, "embedding_config.json")) as f:
+        config = json.load(f)
+    tokenizer = Tokenizer.from_file(os.path.join(folder_path, "tokenizer.json"))
+    tokenizer.enable_truncation(max_length=config["max_seq_length"])
+    tokenizer.enable_padding(
+        pad_id=config["pad_token_id"], pad_token=config["pad_token"]
+    )
+    session = onnxruntime.InferenceSession(
+        os.path.join(folder_path, "model.onnx"), providers=["CPUExecutionProvider"]
+    )
+    encodings = tokenizer.encode_batch(texts)
+    input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+    attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+    outputs = session.run(
+        None, {"input_ids": input_ids, "attention_mask": attention_mask}
+    )
+    hidden: npt.NDArray[np.float32] = outputs[0]
+    if config["pooling"] == "cls":
+        return hidden[:, 0]
+    mask = attention_mask[..., None].astype(hidden.dtype)
+    pooled: npt.NDArray[np.float32] = (hidden * mask).sum(axis=1) / np.clip(
+        mask.sum(axis=1), 1e-9, None
+    )
+    return pooled
+
+
+def _export_onnx_embeddings(
+    embedding_model_name: str,
+    cache_folder: str,
+    folder_path: str,
+    texts: list[str],
+    onnx_params: dict[str, Any],
+) -> None:
+    """Export a sentence-transformers model to ONNX for torch-free query embedding.
+
+    The transformer is exported with dynamic batch and sequence axes, optionally
+    int8-quantized, and saved with its tokenizer and pooling configuration. Raises
+    if the exported model's embeddings of a sample of `texts` drift from the
+    original model's below the configured cosine similarity.
+    """
+    import json
+    import os
+
+    import numpy as np
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    model = SentenceTransformer(
+        embedding_model_name, cache_folder=cache_folder, device="cpu"
+    )
+    transformer = model[0]
+    tokenizer = transformer.tokenizer
+    pooling = next(module for module in model if isinstance(module, Pooling))
+
+    os.makedirs(folder_path, exist_ok=True)
+    tokenizer.save_pretrained(folder_path)
+    with open(os.path.join(folder_path, "embedding_config.json"), "w") as f:
+        json.dump(
+            {
+                "max_seq_length": model.max_seq_length,
+                "pooling": "cls" if pooling.pooling_mode_cls_token else "mean",
+                "normalize": any(isinstance(m, Normalize) for m in model),
+                "pad_token_id": tokenizer.pad_token_id,
+                "pad_token": tokenizer.pad_token,
+            },
+            f,
+        )
+
+    # torch may be untyped, which makes Module Any
+    class _LastHiddenState(torch.nn.Module):  # type: ignore[misc,unused-ignore]
+        def __init__(self, auto_model: torch.nn.Module):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(
+            self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+        ) -> torch.Tensor:
+            outputs = self.auto_model(
+                input_ids=input_ids, attention_mask=attention_mask
+            )
+            return outputs[0]
+
+    model_path = os.path.join(folder_path, "model.onnx")
+    dummy = tokenizer(["onnx export"], return_tensors="pt")
+    dynamic_axes = {0: "batch", 1: "sequence"}
+    torch.onnx.export(
+        _LastHiddenState(transformer.auto_model).eval(),
+        (dummy["input_ids"], dummy["attention_mask"]),
+        model_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": dynamic_axes,
+            "attention_mask": dynamic_axes,
+            "last_hidden_state": dynamic_axes,
+        },
+        opset_version=14,
+    )
+    if onnx_params.get("quantize", False):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = os.path.join(folder_path, "model.int8.onnx")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        os.replace(quantized_path, model_path)
+
+    sample = texts[: onnx_params.get("parity_samples", 256)]
+    expected = model.encode(sample, normalize_embeddings=True)
+    actual = _onnx_encode(folder_path, sample)
+    actual = actual / np.linalg.norm(actual, axis=1, keepdims=True)
+    similarity = (expected * actual).sum(axis=1)
+    logger.info(
+        "ONNX embedding parity over %d chunks: min cosine %.4f, mean cosine %.4f",
+        len(sample),
+        similarity.min(),
+        similarity.mean(),
+    )
+    min_cosine = onnx_params.get("parity_min_cosine", 0.98)
+    if similarity.min() < min_cosine:
+        raise ValueError(
+            f"ONNX export of {embedding_model_name} diverges from the original model "
+            f"(min cosine similarity {similarity.min():.4f} < {min_cosine})"
+        )
 
 
 def make_vector_db_assets(
-    docs: dict[str, Any], embedding_model_name: str
-) -> tempfile.TemporaryDirectory:
+    docs: dict[str, Callable[[], pd.DataFrame]],
+    embedding_model_name: str,
+    index_params: dict[str, Any] | None = None,
+    embedding_backend: str = "torch",
+    onnx_params: dict[str, Any] | None = None,
+    incremental: dict[str, Any] | None = None,
+    embedding_cache: dict[str, Any] | None = None,
+    encode_params: dict[str, Any] | None = None,
+) -> tempfile.TemporaryDirectory[str]:
     """Build the vector db and prepare it to be persisted.
 
     Parameters
     ----------
-    docs : str
-        json-serialized list of langchain.schema.document.Document objects corresponding
-        to the chunked raw documents (and associated source metadata)
+    docs : dict
+        Partitions of the chunked raw documents (and associated source metadata) as
+        written by `make_chunks`. Partitions are loaded one at a time, so only the
+        embeddings of the whole corpus are held in memory.
     embedding_model_name : str
         Name of the sentence-transformers embedding model to use with the vectorstore
         that will be built
+    index_params : dict, optional
+        FAISS index type and its build/search settings; defaults to an exact flat
+        index. With `report`, a size, build time, latency and recall report against
+        exact search is logged for indexes other than `flat`.
+    embedding_backend : str, optional
+        Backend the custom model uses to embed queries. With `onnx`, the embedding
+        model is exported to ONNX and included in the assets.
+    onnx_params : dict, optional
+        Quantization and parity check settings for the ONNX export
+    incremental : dict, optional
+        With `enabled`, the index kept in `state_dir` from the previous run is
+        updated in place by chunk ID instead of being rebuilt, so only new chunks
+        are embedded. Requires chunks from `make_chunks` in incremental mode.
+    embedding_cache : dict, optional
+        With `enabled`, chunk embeddings are cached on disk in `cache_dir` by text
+        and model, so only chunks never embedded with `embedding_model_name` before
+        are encoded. The model is identified by its name and the Hugging Face Hub
+        commit its weights were loaded from, plus an optional `revision` string.
+    encode_params : dict, optional
+        Embedding `batch_size` and number of encode `processes` (0 for one per CPU).
+        Chunks are encoded sorted by length and the throughput is logged.
 
     Returns
     -------
@@ -110,24 +997,108 @@ def make_vector_db_assets(
         custom model deployment.
     """
     import os
+    import pathlib
     import tempfile
+    import time
 
-    from langchain.schema import Document
-    from langchain_community.vectorstores.faiss import FAISS
-    from langchain_huggingface import HuggingFaceEmbeddings
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
 
     d = tempfile.TemporaryDirectory()
     path_to_d = d.name
 
-    documents = [Document(**doc["kwargs"]) for doc in docs["docs"]]
-
-    embedding_function = HuggingFaceEmbeddings(
-        model_name=embedding_model_name,
+    model = SentenceTransformer(
+        embedding_model_name,
         cache_folder=os.path.join(path_to_d, "sentencetransformers"),
     )
-    texts = [doc.page_content for doc in documents]
-    metadatas = [doc.metadata for doc in documents]
+    encode_params = encode_params or {}
+    batch_size = encode_params.get("batch_size", 32)
+    processes = encode_params.get("processes", 1) or os.cpu_count() or 1
+    pool = _start_encode_pool(model, processes) if processes > 1 else None
+    encoded = {"chunks": 0, "secs": 0.0}
+
+    def _encode(texts: list[str]) -> npt.NDArray[np.float32]:
+        start = time.perf_counter()
+        vectors = _encode_by_length(model, texts, batch_size, pool)
+        encoded["chunks"] += len(texts)
+        encoded["secs"] += time.perf_counter() - start
+        return vectors
+
+    cache = None
+    if embedding_cache and embedding_cache.get("enabled"):
+        cache = _EmbeddingCache(
+            embedding_cache["cache_dir"],
+            f"{embedding_model_name}@{_model_revision(model)}"
+            f"{embedding_cache.get('revision', '')}",
+        )
+
+    def _embed(texts: list[str]) -> npt.NDArray[np.float32]:
+        if cache is None:
+            return _encode(texts)
+        return cache.embed(texts, _encode)
+
+    index_params = index_params or {}
+    try:
+        if incremental and incremental.get("enabled"):
+            index, ids = _update_faiss_index(
+                pathlib.Path(incremental["state_dir"]),
+                _iter_document_batches(docs),
+                _embed,
+                index_params,
+                {
+                    "embedding_model_name": embedding_model_name,
+                    "embedding_model_revision": _model_revision(model),
+                    "index": _index_build_settings(index_params),
+                },
+            )
+        else:
+            vectors = np.concatenate(
+                [
+                    _embed([doc.page_content for doc in batch])
+                    for batch in _iter_document_batches(docs)
+                ]
+            )
+            start = time.perf_counter()
+            index, ids = _make_faiss_index(vectors, index_params), None
+            _report_faiss_index(
+                index, vectors, time.perf_counter() - start, index_params
+            )
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+        if cache is not None:
+            # Also keeps the vectors of a build that failed part way
+            cache.flush()
+    logger.info(
+        "Embedded %d chunks in %.1fs (%.0f chunks/s) with batch size %d and %d "
+        "processes",
+        encoded["chunks"],
+        encoded["secs"],
+        encoded["chunks"] / max(encoded["secs"], 1e-9),
+        batch_size,
+        processes,
+    )
 
-    db = FAISS.from_texts(texts, embedding_function, metadatas=metadatas)
-    db.save_local(os.path.join(path_to_d, "faiss_db"))
+    # Second pass over the partitions, streaming the documents to the docstore
+    _save_vectorstore(
+        os.path.join(path_to_d, "faiss_db"),
+        index,
+        (doc for batch in _iter_document_batches(docs) for doc in batch),
+        ids,
+    )
+    if embedding_backend == "onnx":
+        onnx_params = onnx_params or {}
+        n_samples = onnx_params.get("parity_samples", 256)
+        sample: list[str] = []
+        for batch in _iter_document_batches(docs):
+            sample.extend(doc.page_content for doc in batch[: n_samples - len(sample)])
+            if len(sample) >= n_samples:
+                break
+        _export_onnx_embeddings(
+            embedding_model_name,
+            os.path.join(path_to_d, "sentencetransformers"),
+            os.path.join(path_to_d, "onnx_embeddings"),
+            sample,
+            onnx_params,
+        )
     return d
@@ -35,6 +35,9 @@ def create_pipeline(**kwargs) -> Pipeline:
                 "path_to_source_documents": "rag_raw_docs",
                 "chunk_size": "params:vectorstore.chunk_size",
                 "chunk_overlap": "params:vectorstore.chunk_overlap",
+                "workers": "params:vectorstore.ingest_workers",
+                "incremental": "params:vectorstore.incremental",
+                "files_per_partition": "params:vectorstore.files_per_partition",
             },
             outputs="doc_chunks",
             tags=["checkpoint"],
@@ -45,6 +48,12 @@ def create_pipeline(**kwargs) -> Pipeline:
             inputs={
                 "docs": "doc_chunks",
                 "embedding_model_name": "params:vectorstore.sentence_transformer_model_name",
+                "index_params": "params:vectorstore.index",
+                "embedding_backend": "params:vectorstore.embedding_backend",
+                "onnx_params": "params:vectorstore.onnx",
+                "incremental": "params:vectorstore.incremental",
+                "embedding_cache": "params:vectorstore.embedding_cache",
+                "encode_params": "params:vectorstore.encode",
             },
             outputs="vector_db_assets",
             tags=["checkpoint"],
@@ -60,13 +69,53 @@ def create_pipeline(**kwargs) -> Pipeline:
                 "target_feature_name": "params:custom_model.target_name",
                 "credential_name": "params:dr_credential.name",
                 "embedding_model_name": "params:vectorstore.sentence_transformer_model_name",
+                "embedding_backend": "params:vectorstore.embedding_backend",
                 "azure_endpoint": "params:credentials.azure_openai_llm_credentials.azure_endpoint",
                 "openai_api_version": "params:credentials.azure_openai_llm_credentials.api_version",
                 "openai_deployment_name": "params:credentials.azure_openai_llm_credentials.deployment_name",
                 "temperature": "params:llm.temperature",
                 "max_retries": "params:llm.max_retries",
                 "request_timeout": "params:llm.request_timeout_secs",
+                "http_pool_size": "params:llm.http.pool_size",
+                "http_keepalive_secs": "params:llm.http.keepalive_secs",
+                "http2": "params:llm.http.http2",
+                "rate_limit_tokens_per_minute": "params:llm.rate_limit.tokens_per_minute",
+                "rate_limit_requests_per_minute": "params:llm.rate_limit.requests_per_minute",
+                "expected_completion_tokens": "params:llm.rate_limit.expected_completion_tokens",
+                "hedge_enabled": "params:llm.hedge.enabled",
+                "hedge_percentile": "params:llm.hedge.percentile",
+                "hedge_min_delay_secs": "params:llm.hedge.min_delay_secs",
+                "hedge_deployment_name": "params:llm.hedge.deployment_name",
+                "hedge_azure_endpoint": "params:llm.hedge.azure_endpoint",
+                "retry_max_attempts": "params:llm.retry.max_attempts",
+                "retry_budget_ratio": "params:llm.retry.budget_ratio",
+                "retry_rate_limit_delay_secs": "params:llm.retry.rate_limit_delay_secs",
+                "retry_timeout_delay_secs": "params:llm.retry.timeout_delay_secs",
+                "retry_server_error_delay_secs": "params:llm.retry.server_error_delay_secs",
+                "retry_max_delay_secs": "params:llm.retry.max_delay_secs",
                 "stuff_prompt": "params:llm.stuff_prompt",
+                "max_concurrency": "params:scoring.max_concurrency",
+                "max_documents": "params:scoring.max_documents",
+                "retrieval_only": "params:scoring.retrieval_only",
+                "deadline_secs": "params:scoring.deadline_secs",
+                "coalesce_duplicates": "params:scoring.coalesce_duplicates",
+                "return_stage_metrics": "params:scoring.return_stage_metrics",
+                "arrow_output": "params:scoring.arrow_output",
+                "faiss_load_mode": "params:scoring.faiss_load_mode",
+                "history_max_turns": "params:scoring.chat_history.max_turns",
+                "history_max_tokens": "params:scoring.chat_history.max_tokens",
+                "history_condense": "params:scoring.chat_history.condense",
+                "history_summary_cache_entries": "params:scoring.chat_history.summary_cache_entries",
+                "context_packing_enabled": "params:scoring.context_packing.enabled",
+                "context_token_budget": "params:scoring.context_packing.token_budget",
+                "context_dedupe_threshold": "params:scoring.context_packing.dedupe_threshold",
+                "semantic_cache_enabled": "params:scoring.semantic_cache.enabled",
+                "semantic_cache_threshold": "params:scoring.semantic_cache.threshold",
+                "semantic_cache_max_entries": "params:scoring.semantic_cache.max_entries",
+                "semantic_cache_ttl_secs": "params:scoring.semantic_cache.ttl_secs",
+                "response_cache_enabled": "params:scoring.response_cache.enabled",
+                "response_cache_max_entries": "params:scoring.response_cache.max_entries",
+                "shared_state_dir": "params:scoring.shared_state_dir",
             },
             outputs="model_metadata",
         ),
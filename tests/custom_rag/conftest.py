@@ -0,0 +1,6 @@
+"""Make the custom model importable as `custom`, the way DRUM loads it."""
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[2] / "include" / "custom_rag"))
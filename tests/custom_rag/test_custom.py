@@ -0,0 +1,610 @@
+"""Tests for the custom RAG model."""
+
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+custom = pytest.importorskip("custom")
+benchmark = pytest.importorskip("benchmark")
+
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+import openai  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+from langchain_core.embeddings import DeterministicFakeEmbedding  # noqa: E402
+from langchain_core.messages import AIMessage, HumanMessage  # noqa: E402
+from langchain_core.outputs import ChatGeneration, ChatResult  # noqa: E402
+from langchain_core.runnables import RunnableLambda  # noqa: E402
+from pandas import DataFrame  # noqa: E402
+
+
+class EchoChatModel(benchmark.FakeChatModel):
+    """Answers with the question it was asked, failing questions containing "fail".
+
+    Records every question it is asked in `calls`.
+    """
+
+    latency_secs: float = 0.0
+    jitter_secs: float = 0.0
+    calls: list = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        question = str(messages[-1].content)
+        self.calls.append(question)
+        result = super()._generate(messages, stop, run_manager, **kwargs)
+        if "fail" in question:
+            raise ValueError(f"cannot answer {question}")
+        message = AIMessage(
+            content=f"answer to {question}",
+            usage_metadata=result.generations[0].message.usage_metadata,
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def make_model(tmp_path, llm=None, id_mapped=False, **params):
+    """Model over the benchmark's synthetic vectorstore, with scoring `params`."""
+    embedding_function = DeterministicFakeEmbedding(size=16)
+    texts = benchmark.build_fixture(
+        str(tmp_path / "faiss_db"),
+        embedding_function,
+        50,
+        20,
+        random.Random(0),
+        id_mapped=id_mapped,
+    )
+    model_params = benchmark.load_params([])
+    model_params.update(shared_state_dir=str(tmp_path), **params)
+    model = custom.get_chain(
+        str(tmp_path),
+        llm=llm or EchoChatModel(),
+        embedding_function=embedding_function,
+        **model_params,
+    )
+    return model, texts
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def questions(*values):
+    return DataFrame({"promptText": list(values)})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic clock and sleep of the custom model, advanced by hand."""
+    now = [0.0]
+    monkeypatch.setattr(custom.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(custom.time, "sleep", lambda secs: None)
+    return now
+
+
+class TestScore:
+    def test_returns_rows_in_input_order(self, tmp_path):
+        llm = EchoChatModel(latency_secs=0.02, jitter_secs=0.02)
+        model, _ = make_model(tmp_path, llm, max_concurrency=4)
+        asked = [f"question {i}" for i in range(12)]
+
+        result = custom.score(questions(*asked), model)
+
+        assert result["completion"].tolist() == [f"answer to {q}" for q in asked]
+        assert sorted(llm.calls) == sorted(asked)
+
+    def test_captures_errors_per_row(self, tmp_path):
+        model, _ = make_model(tmp_path)
+
+        result = custom.score(questions("first", "please fail", "third"), model)
+
+        assert result["completion"].tolist() == [
+            "answer to first",
+            "ValueError: cannot answer please fail",
+            "answer to third",
+        ]
+        assert result["CITATION_CONTENT_0"][0] != ""
+
+
+def test_retrieve_batch_matches_one_search_per_query(tmp_path):
+    model, texts = make_model(tmp_path)
+    vectorstore = model.vectorstore
+    queries = [texts[0], texts[7], "unrelated question"]
+
+    documents, scores = custom._retrieve_batch(
+        vectorstore, custom._embed(vectorstore, queries), 4
+    )
+
+    for query, docs, doc_scores in zip(queries, documents, scores):
+        expected = vectorstore.similarity_search_with_relevance_scores(query, k=4)
+        assert docs == [doc for doc, _ in expected]
+        assert doc_scores == pytest.approx([s for _, s in expected])
+    assert documents[1][0].page_content == texts[7]
+
+
+class TestSemanticCache:
+    def test_returns_value_of_similar_question(self, clock):
+        cache = custom.SemanticCache(threshold=0.9, max_entries=10, ttl_secs=60)
+        cache.put("ctx", [1.0, 0.0], "answer")
+
+        assert cache.get("ctx", [0.99, 0.05]) == "answer"
+        assert cache.get("ctx", [0.0, 1.0]) is None
+        assert cache.get("other", [1.0, 0.0]) is None
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_expires_entries_that_were_hit(self, clock):
+        cache = custom.SemanticCache(threshold=0.9, max_entries=10, ttl_secs=10)
+        cache.put("ctx", [1.0, 0.0], "old")
+        clock[0] = 5
+        cache.put("ctx", [0.0, 1.0], "new")
+        clock[0] = 6
+        # The hit moves the old entry behind the newer one in LRU order
+        assert cache.get("ctx", [1.0, 0.0]) == "old"
+
+        clock[0] = 12
+        assert cache.get("ctx", [1.0, 0.0]) is None
+        assert cache.get("ctx", [0.0, 1.0]) == "new"
+
+    def test_evicts_least_recently_used(self, clock):
+        cache = custom.SemanticCache(threshold=0.9, max_entries=2, ttl_secs=60)
+        cache.put("ctx", [1.0, 0.0, 0.0], "a")
+        cache.put("ctx", [0.0, 1.0, 0.0], "b")
+        cache.get("ctx", [1.0, 0.0, 0.0])
+        cache.put("ctx", [0.0, 0.0, 1.0], "c")
+
+        assert cache.get("ctx", [1.0, 0.0, 0.0]) == "a"
+        assert cache.get("ctx", [0.0, 1.0, 0.0]) is None
+
+
+class TestResponseCache:
+    def test_round_trips_answers_with_citations_and_scores(self, tmp_path):
+        cache = custom.ResponseCache(str(tmp_path / "cache.sqlite"), max_entries=10)
+        context = [Document(page_content="text", metadata={"source": "a.md"})]
+        cache.put("key", "answer", context, [0.5])
+
+        assert cache.get("key") == ("answer", context, [0.5])
+        assert cache.get("missing") is None
+
+    def test_answers_repeated_rows_without_the_llm(self, tmp_path):
+        llm = EchoChatModel()
+        model, _ = make_model(tmp_path, llm, response_cache_enabled=True)
+
+        first = custom.score(questions("question"), model)
+        second = custom.score(questions("question"), model)
+
+        assert llm.calls == ["question"]
+        columns = ["completion", *first.filter(like="CITATION").columns]
+        assert second[columns].equals(first[columns])
+
+    def test_key_depends_on_the_vectorstore(self, tmp_path):
+        model, _ = make_model(tmp_path / "a")
+        same, _ = make_model(tmp_path / "b")
+        rebuilt, _ = make_model(tmp_path / "c", id_mapped=True)
+        row = custom._Row(question="question", chat_history=[])
+
+        key = custom._response_cache_key(model, row)
+        assert custom._response_cache_key(same, row) == key
+        assert custom._response_cache_key(rebuilt, row) != key
+
+
+def test_columnar_docstore_reads_records_by_position(tmp_path):
+    texts = benchmark.build_fixture(
+        str(tmp_path),
+        DeterministicFakeEmbedding(size=16),
+        5,
+        10,
+        random.Random(0),
+    )
+
+    docstore = custom.ColumnarDocstore(str(tmp_path))
+
+    assert len(docstore) == 5
+    assert docstore.search(3) == Document(
+        page_content=texts[3], metadata={"source": "doc_3.md"}
+    )
+
+
+def test_sorted_id_map_maps_ids_to_positions():
+    ids = custom.SortedIdMap(np.array([7, 3, 11], dtype=np.int64))
+
+    assert (ids[7], ids[3], ids[11]) == (0, 1, 2)
+    assert list(ids) == [3, 7, 11] and len(ids) == 3
+    for missing in (0, 4, 12):
+        with pytest.raises(KeyError):
+            ids[missing]
+
+
+@pytest.mark.parametrize("id_mapped", [False, True])
+def test_loaded_vectorstore_finds_the_indexed_documents(tmp_path, id_mapped):
+    model, texts = make_model(tmp_path, id_mapped=id_mapped)
+
+    found = model.vectorstore.similarity_search(texts[10], k=1)
+
+    assert found[0].page_content == texts[10]
+    assert found[0].metadata == {"source": "doc_10.md"}
+
+
+class TestPackContext:
+    def test_merge_overlap(self):
+        assert custom._merge_overlap("abcdef", "defgh", anchor=2) == "abcdefgh"
+        assert custom._merge_overlap("abcdef", "xyz", anchor=2) is None
+
+    def test_merges_overlapping_chunks_of_the_same_source(self):
+        words = [f"word{i}" for i in range(60)]
+        first, second = " ".join(words[:40]), " ".join(words[20:])
+        documents = [
+            Document(page_content=first, metadata={"source": "a"}),
+            Document(page_content=second, metadata={"source": "a"}),
+            Document(page_content=second, metadata={"source": "b"}),
+        ]
+
+        packed = custom.pack_context(documents, count_words)
+
+        assert [doc.page_content for doc in packed] == [" ".join(words), second]
+
+    def test_drops_near_duplicates_and_fills_token_budget(self):
+        documents = [
+            Document(page_content="one two three", metadata={"source": "a"}),
+            Document(page_content="three two one", metadata={"source": "b"}),
+            Document(page_content="four five six seven", metadata={"source": "c"}),
+            Document(page_content="eight nine", metadata={"source": "d"}),
+        ]
+
+        packed = custom.pack_context(
+            documents, count_words, token_budget=6, dedupe_threshold=0.9
+        )
+
+        assert [doc.metadata["source"] for doc in packed] == ["a", "d"]
+
+    def test_packing_settings_are_part_of_the_context_key(self, tmp_path):
+        model, _ = make_model(tmp_path)
+        row = custom._Row(question="question", chat_history=[])
+        key = custom._context_key(model, row)
+
+        model.params["context_token_budget"] += 1
+
+        assert custom._context_key(model, row) != key
+
+
+class TestRateLimiter:
+    def test_waits_for_the_token_bucket_to_refill(self, clock):
+        limiter = custom.RateLimiter(tokens_per_minute=600, requests_per_minute=0)
+
+        assert limiter.acquire(60) == 0
+        assert limiter.acquire(60) == pytest.approx(2.0)
+        clock[0] = 4.0
+        assert limiter.acquire(10) == 0
+
+    def test_try_acquire_does_not_overdraw(self, clock):
+        limiter = custom.RateLimiter(tokens_per_minute=600, requests_per_minute=60)
+
+        assert limiter.try_acquire(80)
+        assert not limiter.try_acquire(80)
+        clock[0] = 8.0
+        assert limiter.try_acquire(80)
+
+    def test_workers_share_buckets_of_the_same_deployment(self, clock, tmp_path):
+        path = str(tmp_path / "rate_limit.sqlite")
+
+        def make_limiter(key):
+            return custom.RateLimiter(
+                tokens_per_minute=600, requests_per_minute=0, path=path, key=key
+            )
+
+        first, second, other = make_limiter("a"), make_limiter("a"), make_limiter("b")
+
+        assert first.acquire(60) == 0
+        assert second.acquire(60) == pytest.approx(2.0)
+        assert other.acquire(60) == 0
+
+
+def delayed(secs, result):
+    """Chain returning `result`, or raising it if it is an exception, after `secs`."""
+
+    def _invoke(inputs):
+        time.sleep(secs)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return RunnableLambda(_invoke)
+
+
+class TestHedger:
+    def make_hedger(self, secondary, rate_limiter=None):
+        return custom.Hedger(
+            secondary,
+            percentile=95,
+            min_delay_secs=0.05,
+            max_workers=4,
+            rate_limiter=rate_limiter,
+        )
+
+    def test_does_not_hedge_fast_calls(self):
+        hedger = self.make_hedger(delayed(0, "secondary"))
+
+        assert hedger.invoke(delayed(0, "primary"), {}) == "primary"
+        assert (hedger.fired, hedger.won) == (0, 0)
+
+    def test_uses_the_secondary_when_it_answers_first(self):
+        hedger = self.make_hedger(delayed(0, "secondary"))
+
+        assert hedger.invoke(delayed(0.5, "primary"), {}) == "secondary"
+        assert (hedger.fired, hedger.won) == (1, 1)
+
+    def test_waits_for_the_primary_when_the_secondary_fails(self):
+        hedger = self.make_hedger(delayed(0, ValueError("secondary failed")))
+
+        assert hedger.invoke(delayed(0.2, "primary"), {}) == "primary"
+        assert (hedger.fired, hedger.won) == (1, 0)
+
+    def test_reports_the_primary_error_when_both_fail(self):
+        hedger = self.make_hedger(delayed(0, ValueError("secondary failed")))
+
+        with pytest.raises(ValueError, match="primary failed"):
+            hedger.invoke(delayed(0.2, ValueError("primary failed")), {})
+
+    def test_skips_hedges_the_rate_limit_does_not_cover(self):
+        limiter = custom.RateLimiter(tokens_per_minute=600, requests_per_minute=0)
+        hedger = self.make_hedger(delayed(0, "secondary"), limiter)
+        # Use up the burst the bucket allows
+        assert limiter.try_acquire(100)
+
+        assert hedger.invoke(delayed(0.2, "primary"), {}, tokens=100) == "primary"
+        assert (hedger.fired, hedger.skipped) == (0, 1)
+
+
+def rate_limit_error(retry_after_ms):
+    response = httpx.Response(
+        429,
+        headers={"retry-after-ms": str(retry_after_ms)},
+        request=httpx.Request("POST", "https://example.com"),
+    )
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+def failing_call(*errors):
+    """LLM call raising `errors` in turn, then answering."""
+    errors = list(errors)
+
+    def _call():
+        if errors:
+            raise errors.pop(0)
+        return "answer"
+
+    return _call
+
+
+class TestInvokeLlm:
+    @pytest.fixture
+    def sleeps(self, clock, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(custom.time, "sleep", sleeps.append)
+        return sleeps
+
+    def invoke(self, batch, call, **params):
+        model = SimpleNamespace(
+            params={**benchmark.load_params([]), **params}, rate_limiter=None
+        )
+        row = custom._Row(question="question", chat_history=[])
+        return row, custom._invoke_llm(model, batch, row, "answer", 100, call)
+
+    def make_batch(self, n_rows, **params):
+        return custom._Batch(n_rows, {**benchmark.load_params([]), **params})
+
+    def test_retries_transient_errors_honouring_retry_after(self, sleeps):
+        call = failing_call(rate_limit_error(1500), rate_limit_error(1500))
+
+        row, answer = self.invoke(self.make_batch(4), call)
+
+        assert answer == "answer"
+        assert row.retries == 2
+        assert len(sleeps) == 2 and min(sleeps) >= 1.5
+
+    def test_does_not_retry_other_errors(self, sleeps):
+        with pytest.raises(ValueError):
+            self.invoke(self.make_batch(4), failing_call(ValueError("bad request")))
+        assert sleeps == []
+
+    def test_retries_draw_on_the_batch_budget(self, sleeps):
+        # Half a retry per row rounds up to one retry for the batch
+        batch = self.make_batch(1, retry_budget_ratio=0.5)
+
+        self.invoke(batch, failing_call(rate_limit_error(0)))
+        with pytest.raises(openai.RateLimitError):
+            self.invoke(batch, failing_call(rate_limit_error(0)))
+        assert len(sleeps) == 1
+
+    def test_gives_up_when_the_backoff_passes_the_deadline(self, sleeps):
+        batch = self.make_batch(4, deadline_secs=1.0)
+
+        with pytest.raises(openai.RateLimitError):
+            self.invoke(batch, failing_call(rate_limit_error(5000)))
+        assert sleeps == []
+
+
+def test_score_fails_rows_past_the_batch_deadline(tmp_path):
+    llm = EchoChatModel(latency_secs=0.5)
+    model, _ = make_model(tmp_path, llm, deadline_secs=0.1)
+
+    start = time.perf_counter()
+    result = custom.score(questions("first", "second"), model)
+
+    assert time.perf_counter() - start < 0.4
+    assert (
+        result["completion"].tolist()
+        == ["DeadlineExceeded: batch deadline of 0.1s exceeded"] * 2
+    )
+
+
+class TestCoalescing:
+    def test_copy_duplicates_keeps_first_row_outcome(self):
+        rows = [
+            custom._Row(question="q", chat_history=[], key="k", answer="ok"),
+            custom._Row(question="q", chat_history=[], key="k", error="boom"),
+            custom._Row(question="other", chat_history=[], key="j", answer="other"),
+        ]
+        rows[0].scores = [0.9]
+
+        custom._copy_duplicates(rows)
+
+        assert (rows[1].answer, rows[1].error, rows[1].scores) == ("ok", None, [0.9])
+        assert [row.coalesced for row in rows] == [False, True, False]
+        assert rows[2].answer == "other"
+
+    def test_in_flight_requests_share_the_owner_result(self):
+        in_flight = custom.InFlightRequests()
+        future, owner = in_flight.claim("key")
+        waiting, waiter_owns = in_flight.claim("key")
+
+        in_flight.release("key", future, "result")
+
+        assert (owner, waiter_owns) == (True, False)
+        assert waiting.result(timeout=0) == "result"
+        assert in_flight.claim("key")[1]
+        assert in_flight.coalesced == 1
+
+    def test_scores_duplicate_rows_once(self, tmp_path):
+        llm = EchoChatModel()
+        model, _ = make_model(tmp_path, llm)
+
+        result = custom.score(questions("q", "r", "q"), model)
+
+        assert sorted(llm.calls) == ["q", "r"]
+        assert result["completion"].tolist() == [
+            "answer to q",
+            "answer to r",
+            "answer to q",
+        ]
+
+    def test_concurrent_calls_wait_for_rows_in_flight(self, tmp_path):
+        llm = EchoChatModel(latency_secs=0.3)
+        model, _ = make_model(tmp_path, llm)
+        results = [None, None]
+
+        def _score(i):
+            results[i] = custom.score(questions("q"), model)
+
+        threads = [threading.Thread(target=_score, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert llm.calls == ["q"]
+        assert [r["completion"][0] for r in results] == ["answer to q"] * 2
+        assert model.in_flight.coalesced == 1
+
+
+class TestWindowChatHistory:
+    history = [
+        HumanMessage("one two"),
+        AIMessage("three"),
+        HumanMessage("four"),
+        AIMessage("five six seven"),
+        HumanMessage("eight"),
+    ]
+
+    def test_unlimited_keeps_everything(self):
+        assert custom.window_chat_history(self.history, count_words) == (
+            [],
+            self.history,
+        )
+
+    def test_keeps_whole_recent_turns(self):
+        older, recent = custom.window_chat_history(
+            self.history, count_words, max_turns=2
+        )
+
+        assert older == self.history[:2]
+        assert recent == self.history[2:]
+
+    def test_token_limit_drops_turns_that_do_not_fit(self):
+        older, recent = custom.window_chat_history(
+            self.history, count_words, max_tokens=4
+        )
+
+        assert older == self.history[:4]
+        assert recent == self.history[4:]
+
+    def test_condensed_turns_are_summarized_once(self, tmp_path):
+        llm = EchoChatModel()
+        model, _ = make_model(tmp_path, llm, history_max_turns=1, history_condense=True)
+        history = [
+            {"type": "human", "content": "first question"},
+            {"type": "ai", "content": "first answer"},
+            {"type": "human", "content": "second question"},
+            {"type": "ai", "content": "second answer"},
+        ]
+        data = questions("third question").assign(messages=json.dumps(history))
+
+        for _ in range(2):
+            custom.score(data, model)
+
+        assert llm.calls.count("Summarize the conversation above.") == 1
+        assert llm.calls.count("third question") == 4
+
+
+class TestRetrievalOnly:
+    def test_flagged_rows_skip_the_llm(self, tmp_path):
+        llm = EchoChatModel()
+        model, texts = make_model(tmp_path, llm)
+        data = questions(texts[3], "answered").assign(retrieval_only=["true", None])
+
+        result = custom.score(data, model)
+
+        assert llm.calls == ["answered"]
+        assert result["completion"].tolist() == ["", "answer to answered"]
+        assert result["CITATION_CONTENT_0"][0] == texts[3]
+        assert not result.filter(like="CITATION_SCORE").isna().any().any()
+
+    def test_runtime_parameter_applies_to_every_row(self, tmp_path):
+        llm = EchoChatModel()
+        model, _ = make_model(tmp_path, llm, retrieval_only=True)
+
+        result = custom.score(questions("first", "second"), model)
+
+        assert llm.calls == []
+        assert result["completion"].tolist() == ["", ""]
+
+
+class TestAssembleResult:
+    def assemble(self, **params):
+        model = SimpleNamespace(
+            params={**benchmark.load_params([]), "max_documents": 3, **params}
+        )
+        found = custom._Row(question="q", chat_history=[], answer="answer")
+        found.context = [
+            Document(page_content="a", metadata={"source": "a.md", "page": 2}),
+            Document(page_content="b", metadata={}),
+        ]
+        found.scores = [0.9, None]
+        failed = custom._Row(question="r", chat_history=[], error="Error: boom")
+        return custom._assemble_result(model, [found, failed])
+
+    def test_pads_citations_to_max_documents(self):
+        result = self.assemble()
+
+        assert result["completion"].tolist() == ["answer", "Error: boom"]
+        assert result["CITATION_CONTENT_0"].tolist() == ["a", ""]
+        assert result["CITATION_SOURCE_0"].tolist() == ["a.md", ""]
+        assert result["CITATION_PAGE_0"].tolist() == ["2", ""]
+        assert result["CITATION_SOURCE_1"].tolist() == ["", ""]
+        assert result["CITATION_CONTENT_2"].tolist() == ["", ""]
+        assert result["CITATION_SCORE_0"].tolist()[0] == 0.9
+        assert result[["CITATION_SCORE_1", "CITATION_SCORE_2"]].isna().all().all()
+        assert result["PROMPT_TOKENS"].tolist() == [0, 0]
+
+    def test_arrow_output_has_the_same_values(self):
+        pytest.importorskip("pyarrow", exc_type=ImportError)
+        result = self.assemble(arrow_output=True)
+
+        assert str(result["completion"].dtype).endswith("[pyarrow]")
+        expected = self.assemble()
+        assert (
+            result.astype(object)
+            .fillna(np.nan)
+            .equals(expected.astype(object).fillna(np.nan))
+        )
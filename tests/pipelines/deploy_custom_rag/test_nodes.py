@@ -0,0 +1,235 @@
+"""Tests for the embedding cache and FAISS index helpers of deploy_custom_rag."""
+
+import json
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+np = pytest.importorskip("numpy")
+faiss = pytest.importorskip("faiss")
+
+from langchain_core.documents import Document  # noqa: E402
+
+from aragog.pipelines.deploy_custom_rag.nodes import (  # noqa: E402
+    _chunk_incrementally,
+    _chunk_partition,
+    _EmbeddingCache,
+    _index_build_settings,
+    _make_faiss_index,
+    _update_faiss_index,
+)
+
+
+class RecordingEmbedder:
+    """Deterministic fake embedding model that records the texts it embeds."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return np.stack(
+            [
+                np.random.default_rng(zlib.crc32(text.encode())).random(8)
+                for text in texts
+            ]
+        ).astype(np.float32)
+
+
+def make_batch(chunk_ids):
+    return [
+        Document(page_content=f"chunk {i}", metadata={"chunk_id": i}) for i in chunk_ids
+    ]
+
+
+def chunk_lines(path):
+    """Chunk a file into one record per line."""
+    return [
+        {"page_content": line, "metadata": {"source": path.name}}
+        for line in path.read_text().splitlines()
+    ]
+
+
+def make_settings(index_params, model="model"):
+    return {"embedding_model_name": model, "index": _index_build_settings(index_params)}
+
+
+class TestEmbeddingCache:
+    def test_embeds_each_text_once_per_build(self, tmp_path):
+        embed = RecordingEmbedder()
+        cache = _EmbeddingCache(str(tmp_path), "model@abc")
+
+        first = cache.embed(["a b", "c", "a  b"], embed)
+        second = cache.embed(["c", "d"], embed)
+
+        assert embed.calls == [["a b", "c"], ["d"]]
+        np.testing.assert_array_equal(first[0], first[2])
+        np.testing.assert_array_equal(first[1], second[0])
+
+    def test_flush_writes_one_shard_reused_by_later_builds(self, tmp_path):
+        cache = _EmbeddingCache(str(tmp_path), "model@abc")
+        expected = cache.embed(["a", "b"], RecordingEmbedder())
+        cache.embed(["c"], RecordingEmbedder())
+        cache.flush()
+
+        shards = os.listdir(cache.folder_path)
+        assert len(shards) == 1 and shards[0].startswith("shard-")
+        embed = RecordingEmbedder()
+        reused = _EmbeddingCache(str(tmp_path), "model@abc").embed(["b", "a"], embed)
+        assert embed.calls == []
+        np.testing.assert_array_equal(reused, expected[::-1])
+
+    def test_is_keyed_by_model(self, tmp_path):
+        cache = _EmbeddingCache(str(tmp_path), "model@abc")
+        cache.embed(["a"], RecordingEmbedder())
+        cache.flush()
+
+        embed = RecordingEmbedder()
+        _EmbeddingCache(str(tmp_path), "model@def").embed(["a"], embed)
+        assert embed.calls == [["a"]]
+
+
+class TestUpdateFaissIndex:
+    def test_embeds_only_new_chunks_and_removes_stale_ones(self, tmp_path):
+        _update_faiss_index(
+            tmp_path,
+            [make_batch([1, 2, 3])],
+            RecordingEmbedder(),
+            {},
+            make_settings({}),
+        )
+
+        embed = RecordingEmbedder()
+        index, ids = _update_faiss_index(
+            tmp_path,
+            [make_batch([2, 3]), make_batch([4])],
+            embed,
+            {},
+            make_settings({}),
+        )
+
+        assert embed.calls == [["chunk 4"]]
+        assert ids.tolist() == [2, 3, 4]
+        assert index.ntotal == 3
+        _, found = index.search(embed(["chunk 4"]), 1)
+        assert found[0, 0] == 4
+
+    def test_rebuilds_when_the_model_changes(self, tmp_path):
+        _update_faiss_index(
+            tmp_path, [make_batch([1, 2])], RecordingEmbedder(), {}, make_settings({})
+        )
+
+        embed = RecordingEmbedder()
+        index, _ = _update_faiss_index(
+            tmp_path, [make_batch([1, 2])], embed, {}, make_settings({}, "other")
+        )
+
+        assert embed.calls == [["chunk 1", "chunk 2"]]
+        assert index.ntotal == 2
+
+    def test_rebuilds_when_build_settings_change(self, tmp_path):
+        params = {"type": "ivf_flat", "ivf_nlist": 2}
+        _update_faiss_index(
+            tmp_path,
+            [make_batch(range(8))],
+            RecordingEmbedder(),
+            params,
+            make_settings(params),
+        )
+
+        embed = RecordingEmbedder()
+        params = {**params, "ivf_nlist": 4}
+        index, _ = _update_faiss_index(
+            tmp_path, [make_batch(range(8))], embed, params, make_settings(params)
+        )
+
+        assert len(embed.calls) == 1
+        assert faiss.extract_index_ivf(index).nlist == 4
+
+    def test_reuses_the_index_when_only_search_settings_change(self, tmp_path):
+        params = {"type": "ivf_flat", "ivf_nlist": 2, "ivf_nprobe": 1}
+        _update_faiss_index(
+            tmp_path,
+            [make_batch(range(8))],
+            RecordingEmbedder(),
+            params,
+            make_settings(params),
+        )
+
+        embed = RecordingEmbedder()
+        params = {**params, "ivf_nprobe": 2, "report": True, "report_k": 5}
+        index, _ = _update_faiss_index(
+            tmp_path, [make_batch(range(8))], embed, params, make_settings(params)
+        )
+
+        assert embed.calls == []
+        assert faiss.extract_index_ivf(index).nprobe == 2
+        saved = faiss.read_index(str(tmp_path / "index.faiss"))
+        assert faiss.extract_index_ivf(saved).nprobe == 2
+
+
+@pytest.mark.parametrize(
+    "index_type", ["flat", "hnsw", "ivf_flat", "ivf_pq", "sq8", "sq_fp16"]
+)
+def test_index_types_find_indexed_vectors(index_type):
+    vectors = np.random.default_rng(0).random((300, 16), dtype=np.float32)
+    index_params = {"type": index_type, "ivf_nlist": 4, "ivf_nprobe": 4, "pq_m": 4}
+
+    index = _make_faiss_index(vectors, index_params, np.arange(300) * 2)
+
+    _, found = index.search(vectors[:20], 1)
+    assert (found[:, 0] == np.arange(20) * 2).mean() >= 0.8
+
+
+def test_ivf_pq_trains_on_fewer_vectors_than_codes():
+    vectors = np.random.default_rng(0).random((100, 16), dtype=np.float32)
+    index_params = {"type": "ivf_pq", "ivf_nlist": 4, "pq_m": 4, "pq_nbits": 8}
+
+    index = _make_faiss_index(vectors, index_params)
+
+    assert index.ntotal == 100
+    assert index.pq.nbits < 8
+
+
+def test_incremental_chunking_rechunks_only_changed_files(tmp_path):
+    source, state_dir = tmp_path / "source", tmp_path / "state"
+    source.mkdir()
+    for name, text in [("a.md", "a1\na2"), ("b.md", "b1"), ("c.md", "c1")]:
+        (source / name).write_text(text)
+
+    def _chunk(files):
+        paths = _chunk_incrementally(
+            files, source, chunk_lines, None, 1, state_dir, {"chunk_size": 10}, 2
+        )
+        return {
+            record["page_content"]: record["metadata"]["chunk_id"]
+            for path in paths
+            for record in json.loads(path.read_text())
+        }
+
+    first = _chunk(sorted(source.iterdir()))
+    (source / "b.md").write_text("b1\nb2")
+    (source / "c.md").unlink()
+    second = _chunk(sorted(source.iterdir()))
+
+    assert first == {"a1": 0, "a2": 1, "b1": 2, "c1": 3}
+    assert second == {"a1": 0, "a2": 1, "b1": 4, "b2": 5}
+
+
+def test_partitions_share_one_process_pool_and_keep_file_order(tmp_path):
+    files = []
+    for i in range(6):
+        files.append(tmp_path / f"{i}.md")
+        files[-1].write_text(f"{i}a\n{i}b")
+    executor = ProcessPoolExecutor(max_workers=2)
+
+    first = _chunk_partition(files[:3], chunk_lines, executor, 2)
+    second = _chunk_partition(files[3:], chunk_lines, executor, 2, last=True)
+
+    assert first["page_content"].tolist() == ["0a", "0b", "1a", "1b", "2a", "2b"]
+    assert second["page_content"].tolist() == ["3a", "3b", "4a", "4b", "5a", "5b"]
+    assert json.loads(second["metadata"][0]) == {"source": "3.md"}
+    with pytest.raises(RuntimeError):
+        executor.submit(print)